@@ -0,0 +1 @@
+Added the simulation.batch_size parameter to write the simulated images in blocks
@@ -0,0 +1 @@
+Added a multiprocessing cluster method to simulate the images in a pool of local processes
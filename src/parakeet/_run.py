@@ -130,6 +130,11 @@ def _run_Config(
     if "sample.add_molecules" in steps:
         sample = parakeet.sample.add_molecules(config.sample, sample)  # type: ignore
 
+    # Close the sample and open it again read only. This writes any changes to
+    # the file and lets the cluster workers open the file while it is open here
+    sample.close()
+    sample = parakeet.sample.load(sample_file)
+
     # Simulate the exit wave
     if "simulate.exit_wave" in steps:
         parakeet.simulate.exit_wave(config, sample, exit_wave_file)  # type: ignore
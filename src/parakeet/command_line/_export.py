@@ -342,7 +342,7 @@ def export_impl(args):
                     "amplitude": lambda x: np.abs(x),
                     "phase": lambda x: np.real(np.angle(x)),
                     "phase_unwrap": lambda x: np.unwrap(np.real(np.angle(x))),
-                    "square": lambda x: np.abs(x) ** 2,
+                    "square": lambda x: np.square(np.real(x)) + np.square(np.imag(x)),
                     "imaginary_square": lambda x: np.imag(x) ** 2 + 1,
                 }[args.complex_mode](reader.data[i, y0:y1, x0:x1])
 
@@ -384,7 +384,7 @@ def export_impl(args):
             "amplitude": lambda x: np.abs(x),
             "phase": lambda x: np.real(np.angle(x)),
             "phase_unwrap": lambda x: np.unwrap(np.real(np.angle(x))),
-            "square": lambda x: np.abs(x) ** 2,
+            "square": lambda x: np.square(np.real(x)) + np.square(np.imag(x)),
             "imaginary_square": lambda x: np.imag(x) ** 2 + 1,
         }[args.complex_mode](image)
 
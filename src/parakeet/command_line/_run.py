@@ -105,7 +105,7 @@ def get_parser(parser: ArgumentParser = None) -> ArgumentParser:
     parser.add_argument(
         "--cluster.method",
         type=str,
-        choices=["sge"],
+        choices=["sge", "multiprocessing"],
         default=None,
         dest="cluster_method",
         help="The cluster method to use",
@@ -14,6 +14,7 @@ import os
 import yaml
 
 from enum import Enum
+from functools import lru_cache
 from pydantic import BaseModel as PydanticBaseModel
 from pydantic import Field
 from typing import List
@@ -712,6 +713,15 @@ class Simulation(BaseModel):
         ),
     )
 
+    batch_size: int = Field(
+        1,
+        gt=0,
+        description=(
+            "The number of images to simulate before writing them to the output "
+            "file as a single block"
+        ),
+    )
+
 
 class ClusterMethod(str, Enum):
     """
@@ -720,6 +730,7 @@ class ClusterMethod(str, Enum):
     """
 
     sge = "sge"
+    multiprocessing = "multiprocessing"
 
 
 class Cluster(BaseModel):
@@ -728,7 +739,14 @@ class Cluster(BaseModel):
 
     """
 
-    method: ClusterMethod = Field(None, description="The cluster method to use")
+    method: ClusterMethod = Field(
+        None,
+        description=(
+            "The cluster method to use. Use sge to submit the jobs to a Sun Grid "
+            "Engine cluster or multiprocessing to run them in a pool of local "
+            "processes. By default the images are simulated in this process."
+        ),
+    )
 
     max_workers: int = Field(1, description="The maximum number of worker processes")
 
@@ -797,6 +815,26 @@ def save(config: Config, filename: str = "config.yaml", **kwargs):
         yaml.safe_dump(d, outfile)
 
 
+@lru_cache(maxsize=32)
+def _load_text(text: str) -> Config:
+    """
+    Load the configuration from the text of a config file
+
+    The result is cached on the contents of the file so a script which runs
+    many commands with the same config only parses and validates it once.
+    Reading the file is cheap next to that and, unlike the modification time,
+    the contents always change when the file is rewritten.
+
+    Args:
+        text: The contents of the config file
+
+    Returns:
+        The configuration object
+
+    """
+    return Config(**yaml.safe_load(text))
+
+
 def load(config: Union[str, dict] = None) -> Config:
     """
     Load the configuration from the various inputs
@@ -809,11 +847,12 @@ def load(config: Union[str, dict] = None) -> Config:
 
     """
 
-    # If the yaml configuration is set then merge the configuration
+    # If the yaml configuration is set then merge the configuration. The
+    # callers modify the configuration so return a copy of the cached one.
     if config:
         if isinstance(config, str):
             with open(config) as infile:
-                config_file = yaml.safe_load(infile)
+                return _load_text(infile.read()).copy(deep=True)
         else:
             config_file = config
     else:
@@ -8,24 +8,302 @@
 # This code is distributed under the GPLv3 license, a copy of
 # which is included in the root directory of this package.
 #
+import concurrent.futures
+import io
+import multiprocessing
+import numpy as np
+import pickle
+import sys
+import threading
+import uuid
 import parakeet.config
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+
+# Arrays at least this size (bytes) are put in shared memory
+SHARED_MEMORY_THRESHOLD = 1024 * 1024
+
+
+# The shared memory segments and objects attached to in this process
+_attached_segments = {}
+_shared_objects = {}
+_attach_lock = threading.Lock()
+
+
+def _attach(name):
+    """
+    Attach to an existing shared memory segment
+
+    The segment is only tracked by the process which created it. Before
+    Python 3.13 attaching registers the segment with the resource tracker
+    which then warns about and unlinks the segment when the worker exits,
+    even though the parent is still using it. Unregistering it afterwards
+    doesn't work either since spawned workers share the resource tracker of
+    the parent so the registration from the parent would be removed. The
+    registration is therefore skipped while attaching.
+
+    Args:
+        name (str): The name of the segment
+
+    Returns:
+        object: The shared memory
+
+    """
+    if sys.version_info >= (3, 13):
+        return SharedMemory(name=name, track=False)
+    with _attach_lock:
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+def _shared_array(name, shape, dtype):
+    """
+    Get a read only view of an array in shared memory
+
+    The segment is kept open for the lifetime of the process so the view
+    stays valid.
+
+    Args:
+        name (str): The name of the segment
+        shape (tuple): The shape of the array
+        dtype (object): The array dtype
+
+    Returns:
+        array: The array view
+
+    """
+    if name not in _attached_segments:
+        _attached_segments[name] = _attach(name)
+    array = np.ndarray(shape, dtype=dtype, buffer=_attached_segments[name].buf)
+    array.flags.writeable = False
+    return array
+
+
+class _SharedMemoryPickler(pickle.Pickler):
+    """
+    A pickler which puts large numpy arrays in shared memory
+
+    Only the name of the segment is pickled and the array is unpickled as a
+    read only view of the shared memory so every process uses the same copy.
+    For example this means the atom data of a sample are not copied to each
+    worker.
+
+    """
+
+    def __init__(self, file, segments):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.segments = segments
+
+    def reducer_override(self, obj):
+        if (
+            type(obj) is np.ndarray
+            and obj.nbytes >= SHARED_MEMORY_THRESHOLD
+            and not obj.dtype.hasobject
+        ):
+            shm = SharedMemory(create=True, size=obj.nbytes)
+            self.segments.append(shm)
+            np.ndarray(obj.shape, dtype=obj.dtype, buffer=shm.buf)[...] = obj
+            return _shared_array, (shm.name, obj.shape, obj.dtype)
+        return NotImplemented
+
+
+class SharedObject(object):
+    """
+    A handle to an object whose large arrays are in shared memory
+
+    The object is pickled once and the handle, which holds the small pickle
+    and the names of the shared memory segments, is sent with each job. The
+    object is then unpickled once in each worker process and the same
+    instance is used for every job which runs there so anything it caches is
+    kept between jobs.
+
+    """
+
+    def __init__(self, obj):
+        """
+        Pickle the object and put its large arrays in shared memory
+
+        Args:
+            obj (object): The object to share
+
+        """
+        buffer = io.BytesIO()
+        self._segments = []
+        try:
+            _SharedMemoryPickler(buffer, self._segments).dump(obj)
+        except Exception:
+            self.release()
+            raise
+        self.key = uuid.uuid4().hex
+        self.data = buffer.getvalue()
+
+    def __getstate__(self):
+        """
+        Don't pickle the shared memory segments which are owned by this process
+
+        """
+        return {"_segments": [], "key": self.key, "data": self.data}
+
+    @property
+    def segments(self):
+        """
+        The names of the shared memory segments
+
+        """
+        return [shm.name for shm in self._segments]
+
+    def result(self):
+        """
+        Get the shared object
+
+        Returns:
+            object: The object
+
+        """
+        if self.key not in _shared_objects:
+            _shared_objects[self.key] = pickle.loads(self.data)
+        return _shared_objects[self.key]
+
+    def release(self):
+        """
+        Free the shared memory
+
+        This must only be called once no job is using the object.
+
+        """
+        for shm in self._segments:
+            shm.close()
+            shm.unlink()
+        self._segments = []
 
 
 def as_completed(futures):
+    futures = list(futures)
+    if all(isinstance(f, concurrent.futures.Future) for f in futures):
+        return concurrent.futures.as_completed(futures)
+
     import dask.distributed
 
     return dask.distributed.as_completed(futures)
 
 
+def wait(futures):
+    """
+    Wait until at least one of the futures has completed
+
+    Args:
+        futures (list): The futures to wait on
+
+    Returns:
+        tuple: The set of done and not done futures
+
+    """
+    futures = list(futures)
+    if all(isinstance(f, concurrent.futures.Future) for f in futures):
+        done, not_done = concurrent.futures.wait(
+            futures, return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        return done, not_done
+
+    import dask.distributed
+
+    done, not_done = dask.distributed.wait(futures, return_when="FIRST_COMPLETED")
+    return done, not_done
+
+
+def cancel(futures):
+    """
+    Cancel the futures which have not started and wait for the rest
+
+    Jobs which are already running in a process pool can't be cancelled so
+    these are waited on so they are no longer using any shared memory. Dask
+    futures are only cancelled since dask holds its own copy of the data.
+
+    Args:
+        futures (list): The futures to cancel
+
+    """
+    futures = list(futures)
+    for future in futures:
+        future.cancel()
+    if all(isinstance(f, concurrent.futures.Future) for f in futures):
+        concurrent.futures.wait(futures)
+
+
+def scatter(executor, obj):
+    """
+    Send an object to all the workers once
+
+    A process pool has no way to hold data on the workers so in that case the
+    large arrays of the object are put in shared memory and a handle to it is
+    returned. The handle should be freed with release once no job is running.
+
+    Args:
+        executor (object): The executor
+        obj (object): The object to send
+
+    Returns:
+        object: A handle to the object on the workers
+
+    """
+    if isinstance(executor, concurrent.futures.Executor):
+        return SharedObject(obj)
+    return executor.scatter(obj, broadcast=True)
+
+
+def gather(handle):
+    """
+    Get an object on a worker from the handle returned by scatter
+
+    Dask replaces its own handles with the object before the job is run so
+    these are returned as they are.
+
+    Args:
+        handle (object): The handle to the object
+
+    Returns:
+        object: The object
+
+    """
+    if isinstance(handle, SharedObject):
+        return handle.result()
+    return handle
+
+
+def release(handle):
+    """
+    Free an object sent to the workers by scatter
+
+    Args:
+        handle (object): The handle to the object
+
+    """
+    if isinstance(handle, SharedObject):
+        handle.release()
+
+
 def factory(method="sge", max_workers=1):
     """
     Configure the future to use for parallel processing
 
     Args:
-        method (str): The cluster method (sge)
+        method (str): The cluster method (sge or multiprocessing)
         max_workers (int): The number of worker processes
 
     """
+    if method == "multiprocessing":
+        # Run the jobs in a pool of processes on the local machine. The
+        # processes are spawned rather than forked so that they do not
+        # inherit the open HDF5 files of the parent process.
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+
     import dask_jobqueue
     import dask.distributed
 
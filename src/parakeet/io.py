@@ -742,8 +742,16 @@ class NexusWriter(Writer):
 
         """
 
+        # Store each image in its own chunk so that writing an image never
+        # needs to read back part of another. Make the chunk cache big enough
+        # to hold a few images; the default of 1 MB is smaller than one image
+        # for typical detector sizes
+        chunks = (1,) + tuple(shape[1:])
+        chunk_nbytes = int(np.prod(chunks)) * np.dtype(dtype).itemsize
+        rdcc_nbytes = max(4 * chunk_nbytes, 1024**2)
+
         # Open the file for writing
-        self.handle = h5py.File(filename, "w")
+        self.handle = h5py.File(filename, "w", rdcc_nbytes=rdcc_nbytes)
 
         # Create the entry
         entry = self.handle.create_group("entry")
@@ -757,7 +765,7 @@ class NexusWriter(Writer):
         # Create the detector
         detector = instrument.create_group("detector")
         detector.attrs["NX_class"] = "NXdetector"
-        detector.create_dataset("data", shape=shape, dtype=dtype)
+        detector.create_dataset("data", shape=shape, dtype=dtype, chunks=chunks)
         detector["image_key"] = np.zeros(shape=shape[0])
 
         # Create the sample
@@ -827,7 +835,7 @@ class ImageWriter(Writer):
 
             # Convert to squared amplitude
             if np.iscomplexobj(data):
-                data = np.abs(data) ** 2
+                data = np.square(data.real) + np.square(data.imag)
                 self.vmin = None
                 self.vmax = None
 
@@ -909,6 +917,7 @@ class Reader(object):
         data,
         header,
         pixel_size,
+        filename=None,
     ):
         """
         Initialise the data
@@ -916,6 +925,8 @@ class Reader(object):
         Args:
             data (array): The data array
             header (array): The header data
+            pixel_size (float): The pixel size
+            filename (str): The filename the data was read from
 
         """
         # Check the size
@@ -928,6 +939,23 @@ class Reader(object):
         self.pixel_size = pixel_size
         self.shape = data.shape
         self.dtype = data.dtype
+        self.filename = filename
+
+    def __getstate__(self):
+        """
+        Pickle the reader by filename since the file handle can't be pickled
+
+        """
+        if self.filename is None:
+            raise TypeError("Cannot pickle a reader which was not read from a file")
+        return {"filename": self.filename}
+
+    def __setstate__(self, state):
+        """
+        Reopen the file when the reader is unpickled
+
+        """
+        self.__dict__.update(Reader.from_file(state["filename"]).__dict__)
 
     @property
     def start_angle(self):
@@ -1006,6 +1034,7 @@ class Reader(object):
             handle.data,
             header,
             pixel_size,
+            filename=filename,
         )
 
     @classmethod
@@ -1044,6 +1073,7 @@ class Reader(object):
             data["data"],
             header,
             pixel_size,
+            filename=filename,
         )
 
     @classmethod
@@ -15,6 +15,7 @@ import logging
 import numpy as np
 import pandas
 import scipy.constants
+import itertools
 import json
 from math import pi, sqrt, floor, ceil
 from scipy.spatial.transform import Rotation
@@ -512,18 +513,36 @@ class AtomData(object):
         """
         if len(self.data) == 0:
             return multem.AtomList()
-        return multem.AtomList(
-            zip(
-                self.data["atomic_number"].astype("uint8"),
-                self.data["x"].astype("float32"),
-                self.data["y"].astype("float32"),
-                self.data["z"].astype("float32"),
-                self.data["sigma"].astype("float32"),
-                self.data["occupancy"].astype("float32"),
-                [int(0) for i in range(self.data.shape[0])],
-                self.data["charge"].astype("uint8"),
-            )
-        )
+
+        # Convert the columns to lists of python scalars a chunk of rows at a
+        # time. This is much quicker than iterating through each pandas series
+        # element by element when building the atom list while the temporary
+        # lists are kept small for large samples. The columns are already
+        # stored with these types so no copy is made before the conversion.
+        # Storing sigma or occupancy at lower precision would not save
+        # anything here since every value becomes a python float for the
+        # multem binding.
+        chunk_size = 100_000
+
+        def rows():
+            for i in range(0, self.data.shape[0], chunk_size):
+                chunk = self.data.iloc[i : i + chunk_size]
+
+                def column(name, dtype):
+                    return chunk[name].to_numpy(dtype=dtype).tolist()
+
+                yield from zip(
+                    column("atomic_number", "uint8"),
+                    column("x", "float32"),
+                    column("y", "float32"),
+                    column("z", "float32"),
+                    column("sigma", "float32"),
+                    column("occupancy", "float32"),
+                    itertools.repeat(0, chunk.shape[0]),
+                    column("charge", "uint8"),
+                )
+
+        return multem.AtomList(rows())
 
     def rows(self):
         """
@@ -1113,6 +1132,14 @@ class SampleHDF5Adapter(object):
         """
         self.__handle = h5py.File(filename, mode=mode)
 
+    @property
+    def filename(self):
+        """
+        Get the filename
+
+        """
+        return self.__handle.filename
+
     @property
     def sample(self):
         """
@@ -1162,6 +1189,25 @@ class Sample(object):
         """
         self.__handle.close()
 
+    def __getstate__(self):
+        """
+        Pickle the sample as a handle to the file
+
+        The atom data can be large so rather than serialising it when the
+        sample is sent to a worker process only the filename is sent and the
+        file is opened read only on the other side.
+
+        """
+        return {"filename": self.__handle.filename, "step": self.step}
+
+    def __setstate__(self, state):
+        """
+        Open the sample file when unpickled
+
+        """
+        self.__handle = SampleHDF5Adapter(state["filename"], mode="r")
+        self.step = state["step"]
+
     def atoms_dataset_name(self, x):
         """
         Get the atom dataset name
@@ -1537,10 +1583,10 @@ class Sample(object):
         """
 
         # Iterate over dataset ranges
-        data = pandas.DataFrame()
-        for (x0, x1), atoms in self.iter_atoms():
-            data = pandas.concat([data, atoms.data], ignore_index=True)
-        return AtomData(data=data)
+        data = [atoms.data for (x0, x1), atoms in self.iter_atoms()]
+        if len(data) == 0:
+            return AtomData(data=pandas.DataFrame())
+        return AtomData(data=pandas.concat(data, ignore_index=True))
 
     def get_atoms_in_group(self, name):
         """
@@ -1571,16 +1617,18 @@ class Sample(object):
         assert (x0 < x1).all()
 
         # Iterate over dataset ranges
-        data = pandas.DataFrame()
+        data = []
         for x_min, x_max in self.atoms_dataset_range(x0, x1):
             name = self.atoms_dataset_name(x_min)
             atoms = self.__handle.sample.atoms[name].atoms
-            coords = atoms[["x", "y", "z"]]
+            coords = atoms[["x", "y", "z"]].to_numpy()
             atoms = atoms[((coords >= x0) & (coords < x1)).all(axis=1)]
             if filter is not None:
                 atoms = filter(atoms)
-            data = pandas.concat([data, atoms], ignore_index=True)
-        return AtomData(data=data)
+            data.append(atoms)
+        if len(data) == 0:
+            return AtomData(data=pandas.DataFrame())
+        return AtomData(data=pandas.concat(data, ignore_index=True))
 
     def get_atoms_in_fov(self, x0, x1):
         """
@@ -1605,7 +1653,7 @@ class Sample(object):
         # Iterate over dataset ranges
         atoms = self.get_atoms().data
         if len(atoms) > 0:
-            coords = atoms[["x", "y"]]
+            coords = atoms[["x", "y"]].to_numpy()
             atoms = atoms[((coords >= x0) & (coords < x1)).all(axis=1)]
         return AtomData(data=atoms)
 
@@ -1719,19 +1767,6 @@ class AtomSliceExtractor(object):
 
         """
 
-        # Check if the rectangles overlaps with each other
-        def overlapping(a0, a1, b0, b1):
-            if not (
-                a0[0] > b1[0]
-                or a1[0] < b0[0]
-                or a0[1] > b1[1]
-                or a1[1] < b0[1]
-                or a0[2] > b1[2]
-                or a1[2] < b0[2]
-            ):
-                return True
-            return False
-
         # Set the items
         self.sample = sample
         self.centre = sample.centre
@@ -1741,57 +1776,82 @@ class AtomSliceExtractor(object):
         self.x1 = x1
         self.thickness = thickness
 
-        # Loop through the atom groups
-        group_coords = []
+        # Get the names and minimum coordinates of the atom groups
         group_names = []
+        group_x0 = []
         for name, xmin in self.sample.iter_atom_groups():
-            xmax = xmin + self.sample.step
-
-            # The coordinates of the corners of the group
-            y = np.array(
-                [
-                    (xmin[0], xmin[1], xmin[2]),
-                    (xmin[0], xmin[1], xmax[2]),
-                    (xmin[0], xmax[1], xmin[2]),
-                    (xmin[0], xmax[1], xmax[2]),
-                    (xmax[0], xmin[1], xmin[2]),
-                    (xmax[0], xmin[1], xmax[2]),
-                    (xmax[0], xmax[1], xmin[2]),
-                    (xmax[0], xmax[1], xmax[2]),
-                ]
-            )
-
-            # Rotate the group and translate the corners of the group and
-            # append to the list of groupd
             group_names.append(name)
-            group_coords.append(
-                Rotation.from_rotvec((self.rotation, 0, 0)).apply(y - self.centre)
-                + self.centre
-                - (self.translation, 0, 0)
+            group_x0.append(xmin)
+
+        # The coordinates of the corners of each group. Rotate and translate
+        # the corners of all the groups together.
+        corners = np.array(
+            [(i, j, k) for i in (0, 1) for j in (0, 1) for k in (0, 1)]
+        ) * float(self.sample.step)
+        group_coords = np.array(group_x0)[:, np.newaxis, :] + corners
+        group_coords = (
+            Rotation.from_rotvec((self.rotation, 0, 0)).apply(
+                group_coords.reshape((-1, 3)) - self.centre
             )
+            + self.centre
+            - (self.translation, 0, 0)
+        ).reshape(group_coords.shape)
 
         # Compute the min and max coordinates of all the rotated groups and
         # compute the number of slices we will have
-        group_coords = np.array(group_coords)
         min_x = np.min(group_coords.reshape((-1, 3)), axis=0)
         max_x = np.max(group_coords.reshape((-1, 3)), axis=0)
         self.min_z = max(0, min_x[2])
         self.max_z = max_x[2]
         num_slices = ceil((self.max_z - self.min_z) / self.thickness)
 
-        # Loop through the groups. Compute the minimum and maximum coordinates
-        # of the group and create a new box. Loop through the slices and check
-        # if the box overlaps with the slice box. If it does then add the name
-        # of the group to the list of groups in that slice.
+        # Compute the minimum and maximum coordinates of each group and
+        # check which slice boxes each group box overlaps with in one go. If
+        # a group overlaps with a slice then add the name of the group to the
+        # list of groups in that slice.
+        group_min = np.min(group_coords, axis=1)
+        group_max = np.max(group_coords, axis=1)
+        z0 = self.min_z + np.arange(num_slices) * thickness
+        z1 = self.min_z + (np.arange(num_slices) + 1) * thickness
+        overlapping_xy = ~(
+            (group_min[:, 0] > x1[0])
+            | (group_max[:, 0] < x0[0])
+            | (group_min[:, 1] > x1[1])
+            | (group_max[:, 1] < x0[1])
+        )
+        overlapping_z = ~(
+            (group_min[:, 2, np.newaxis] > z1) | (group_max[:, 2, np.newaxis] < z0)
+        )
+        overlapping = overlapping_xy[:, np.newaxis] & overlapping_z
         self.__groups_in_slice = defaultdict(list)
-        for name, group in zip(group_names, group_coords):
-            min_x = np.min(group, axis=0)
-            max_x = np.max(group, axis=0)
-            for i in range(num_slices):
-                z0 = self.min_z + i * thickness
-                z1 = self.min_z + (i + 1) * thickness
-                if overlapping(min_x, max_x, (x0[0], x0[1], z0), (x1[0], x1[1], z1)):
-                    self.__groups_in_slice[i].append(name)
+        for i, j in zip(*np.nonzero(overlapping.T)):
+            self.__groups_in_slice[int(i)].append(group_names[j])
+
+    def _slice_range(self, index):
+        """
+        Get the min and max coordinate of the slice
+
+        """
+        z0 = self.min_z + index * self.thickness
+        z1 = self.min_z + (index + 1) * self.thickness
+        return (self.x0[0], self.x0[1], z0), (self.x1[0], self.x1[1], z1)
+
+    def _transform(self, atoms):
+        """
+        Rotate and translate the atoms
+
+        Returns:
+            tuple: The transformed atoms and coordinates
+
+        """
+        coords = atoms[["x", "y", "z"]].to_numpy()
+        coords = (
+            Rotation.from_rotvec((0, self.rotation, 0)).apply(coords - self.centre)
+            + self.centre
+            - (0, self.translation, 0)
+        ).astype("float32")
+        atoms = atoms.assign(x=coords[:, 0], y=coords[:, 1], z=coords[:, 2])
+        return atoms, coords
 
     def __getitem__(self, index):
         """
@@ -1806,25 +1866,13 @@ class AtomSliceExtractor(object):
         """
 
         # Get the min and max coordinate of the slice
-        z0 = self.min_z + index * self.thickness
-        z1 = self.min_z + (index + 1) * self.thickness
-        x_min = (self.x0[0], self.x0[1], z0)
-        x_max = (self.x1[0], self.x1[1], z1)
+        x_min, x_max = self._slice_range(index)
 
         # Rotate and translate the atoms and select only those atoms within the
         # slice
         def filter_atoms(atoms):
-            coords = atoms[["x", "y", "z"]].to_numpy()
-            coords = (
-                Rotation.from_rotvec((0, self.rotation, 0)).apply(coords - self.centre)
-                + self.centre
-                - (0, self.translation, 0)
-            ).astype("float32")
-            atoms["x"] = coords[:, 0]
-            atoms["y"] = coords[:, 1]
-            atoms["z"] = coords[:, 2]
-            atoms = atoms[((coords >= x_min) & (coords < x_max)).all(axis=1)]
-            return atoms
+            atoms, coords = self._transform(atoms)
+            return atoms[((coords >= x_min) & (coords < x_max)).all(axis=1)]
 
         # Check the index
         assert index >= 0 and index < len(self.__groups_in_slice)
@@ -1857,11 +1905,54 @@ class AtomSliceExtractor(object):
         """
         Iterate through the slices
 
+        Rather than filtering the atoms in every group for every slice, the
+        atoms in each group are read and transformed once and then bucketed
+        into slices by sorting on the slice index.
+
         """
-        for i in range(len(self)):
-            item = self[i]
-            if len(item.atoms.data) > 0:
-                yield self[i]
+
+        # The boundaries of the slices along z
+        num_slices = len(self)
+        z_edges = self.min_z + np.arange(num_slices + 1) * self.thickness
+
+        # The slices which each group contributes to
+        slices_in_group = defaultdict(list)
+        for i in range(num_slices):
+            for name in self.__groups_in_slice[i]:
+                slices_in_group[name].append(i)
+
+        # Read and transform each group once and compute the slice index of
+        # each atom. Atoms outside the field of view or in slices which the
+        # group doesn't contribute to are discarded.
+        data = []
+        slice_index = []
+        for name, group_slices in slices_in_group.items():
+            atoms, coords = self._transform(self.sample.get_atoms_in_group(name).data)
+            index = np.searchsorted(z_edges, coords[:, 2], side="right") - 1
+            select = (
+                (coords[:, 0] >= self.x0[0])
+                & (coords[:, 0] < self.x1[0])
+                & (coords[:, 1] >= self.x0[1])
+                & (coords[:, 1] < self.x1[1])
+                & np.isin(index, group_slices)
+            )
+            data.append(atoms[select])
+            slice_index.append(index[select])
+        if len(data) == 0:
+            return
+        data = pandas.concat(data, ignore_index=True)
+        slice_index = np.concatenate(slice_index)
+
+        # Sort the atoms by slice and find the start and end of each slice
+        order = np.argsort(slice_index, kind="stable")
+        bounds = np.searchsorted(slice_index[order], np.arange(num_slices + 1))
+        for i in range(num_slices):
+            i0, i1 = bounds[i], bounds[i + 1]
+            if i1 > i0:
+                x_min, x_max = self._slice_range(i)
+                yield AtomSliceExtractor.Slice(
+                    AtomData(data=data.iloc[order[i0:i1]]), x_min, x_max
+                )
 
 
 class AtomDeleter(object):
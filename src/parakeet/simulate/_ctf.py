@@ -91,7 +91,7 @@ class CTFSimulator(object):
         input_multislice.spec_lz = x_fov  # self.sample.containing_box[1][2]
 
         # Run the simulation
-        image = np.array(multem.compute_ctf(system_conf, input_multislice)).T
+        image = np.asarray(multem.compute_ctf(system_conf, input_multislice)).T
         image = np.fft.fftshift(image)
 
         # Compute the image scaled with Poisson noise
@@ -60,6 +60,102 @@ class ExitWaveImageSimulator(object):
         self.scan = scan
         self.simulation = simulation
         self.device = device
+        self._system_conf = None
+        self._input_multislice = None
+        self._atoms = None
+        self._fov = None
+
+    def __getstate__(self):
+        """
+        Don't pickle the cached multem objects
+
+        The atoms are sent with the simulator so they are read from the sample
+        once rather than by every worker. When sent to a process pool the atom
+        data are put in shared memory and used by every worker.
+
+        """
+        state = self.__dict__.copy()
+        state["_system_conf"] = None
+        state["_input_multislice"] = None
+        state["_atoms"] = self.get_atoms()
+        state["_fov"] = None
+        return state
+
+    def get_atoms(self):
+        """
+        Get the sample atoms
+
+        The atoms do not change from image to image so they are read from the
+        sample once and reused. The returned table must not be modified.
+
+        Returns:
+            object: The atom data table
+
+        """
+        if self._atoms is None:
+            self._atoms = self.sample.get_atoms().data
+        return self._atoms
+
+    def get_field_of_view(self):
+        """
+        Get the field of view parameters
+
+        These do not change between images so they are computed once and
+        reused.
+
+        Returns:
+            object: The field of view
+
+        """
+        if self._fov is None:
+            self._fov = parakeet.simulate.simulation.FieldOfView.from_microscope(
+                self.microscope,
+                margin=self.simulation["margin"],
+                padding=self.simulation["padding"],
+            )
+        return self._fov
+
+    def get_input_multislice(self):
+        """
+        Get the multem system configuration and input multislice object
+
+        These are created once on the first call and then reused for each
+        image; only the parameters that change between images need to be
+        updated by the caller.
+
+        Returns:
+            tuple: (system_conf, input_multislice)
+
+        """
+        if self._input_multislice is None:
+            # The field of view
+            fov = self.get_field_of_view()
+
+            # Create the multem system configuration
+            self._system_conf = (
+                parakeet.simulate.simulation.create_system_configuration(self.device)
+            )
+
+            # The Z centre
+            z_centre = self.sample.centre[2]
+
+            # Create the multem input multislice object
+            self._input_multislice = (
+                parakeet.simulate.simulation.create_input_multislice(
+                    self.microscope,
+                    self.simulation["slice_thickness"],
+                    self.simulation["margin"] + self.simulation["padding"],
+                    "EWRS",
+                    z_centre,
+                )
+            )
+
+            # Set the specimen size
+            self._input_multislice.spec_lx = fov.spec_lx
+            self._input_multislice.spec_ly = fov.spec_ly
+            self._input_multislice.spec_lz = self.sample.containing_box[1][2]
+
+        return self._system_conf, self._input_multislice
 
     def get_masker(
         self,
@@ -182,43 +278,14 @@ class ExitWaveImageSimulator(object):
         electrons_per_angstrom = self.scan.electrons_per_angstrom[index]
 
         # The field of view
-        nx = self.microscope.detector.nx
-        ny = self.microscope.detector.ny
-        pixel_size = self.microscope.detector.pixel_size
-        origin = np.array(self.microscope.detector.origin)
-        margin = self.simulation["margin"]
-        padding = self.simulation["padding"]
-        x_fov = nx * pixel_size
-        y_fov = ny * pixel_size
-        # margin_offset = margin * pixel_size
-        # padding_offset = padding * pixel_size
-        offset = (padding + margin) * pixel_size
-
-        # Create the multem system configuration
-        system_conf = parakeet.simulate.simulation.create_system_configuration(
-            self.device
-        )
-
-        # The Z centre
-        z_centre = self.sample.centre[2]
-
-        # Create the multem input multislice object
-        input_multislice = parakeet.simulate.simulation.create_input_multislice(
-            self.microscope,
-            self.simulation["slice_thickness"],
-            self.simulation["margin"] + self.simulation["padding"],
-            "EWRS",
-            z_centre,
-        )
-
-        # Set the specimen size
-        input_multislice.spec_lx = x_fov + offset * 2
-        input_multislice.spec_ly = y_fov + offset * 2
-        input_multislice.spec_lz = self.sample.containing_box[1][2]
+        fov = self.get_field_of_view()
+
+        # Get the multem system configuration and input multislice object
+        system_conf, input_multislice = self.get_input_multislice()
 
         # Set the beam tilt
-        input_multislice.theta += beam_tilt_theta
-        input_multislice.phi += beam_tilt_phi
+        input_multislice.theta = self.microscope.beam.theta + beam_tilt_theta
+        input_multislice.phi = self.microscope.beam.phi + beam_tilt_phi
 
         # Compute the B factor
         if self.simulation["radiation_damage_model"]:
@@ -234,38 +301,31 @@ class ExitWaveImageSimulator(object):
         else:
             input_multislice.static_B_factor = 0
 
-        # Set the atoms in the input after translating them for the offset
-        atoms = self.sample.get_atoms()
+        # Rotate the atoms about the sample centre and translate them for the
+        # stage position and the detector so the corner of the padded field of
+        # view is at zero. The atoms outside the field of view are dropped and
+        # only the selected rows are copied back.
+        atoms = parakeet.sample.AtomData(data=self.get_atoms())
         logger.info("Simulating with %d atoms" % atoms.data.shape[0])
         if len(atoms.data) > 0:
-            coords = atoms.data[["x", "y", "z"]].to_numpy()
-            coords = (
-                R.from_rotvec(orientation).apply(coords - self.sample.centre)
-                + self.sample.centre
+            centre = np.array(self.sample.centre)
+            translation = (
+                centre
                 - position
-            ).astype("float32")
-            atoms.data["x"] = coords[:, 0]
-            atoms.data["y"] = coords[:, 1]
-            atoms.data["z"] = coords[:, 2]
-
-        # Select atoms in FOV
-        fov_xmin = origin[0] - offset
-        fov_xmax = fov_xmin + x_fov + 2 * offset
-        fov_ymin = origin[1] - offset
-        fov_ymax = fov_ymin + y_fov + 2 * offset
-        if len(atoms.data) > 0:
-            select = (
-                (atoms.data["x"] >= fov_xmin)
-                & (atoms.data["x"] <= fov_xmax)
-                & (atoms.data["y"] >= fov_ymin)
-                & (atoms.data["y"] <= fov_ymax)
+                + (fov.offset - fov.origin[0], fov.offset - fov.origin[1], 0)
             )
-            atoms.data = atoms.data[select]
-
-        # Translate for the detector
-        input_multislice.spec_atoms = atoms.translate(
-            (offset - origin[0], offset - origin[1], 0)
-        ).to_multem()
+            select, coords = parakeet.simulate.simulation.transform_atoms(
+                atoms.data[["x", "y", "z"]].to_numpy(),
+                centre,
+                R.from_rotvec(orientation).as_matrix(),
+                translation,
+                (0, 0, -np.inf),
+                (fov.spec_lx, fov.spec_ly, np.inf),
+            )
+            atoms.data = atoms.data[select].assign(
+                x=coords[:, 0], y=coords[:, 1], z=coords[:, 2]
+            )
+        input_multislice.spec_atoms = atoms.to_multem()
         logger.info("   Got spec atoms")
 
         if len(atoms.data) > 0:
@@ -287,10 +347,10 @@ class ExitWaveImageSimulator(object):
             masker = self.get_masker(
                 index,
                 input_multislice,
-                pixel_size,
+                fov.pixel_size,
                 drift,
-                origin,
-                offset,
+                fov.origin,
+                fov.offset,
                 orientation,
                 position,
             )
@@ -306,23 +366,24 @@ class ExitWaveImageSimulator(object):
         # Get the ideal image data
         # Multem outputs data in column major format. In C++ and Python we
         # generally deal with data in row major format so we must do a
-        # transpose here.
-        image = np.array(output_multislice.data[0].psi_coh).T
-        x0 = padding
-        y0 = padding
-        x1 = image.shape[1] - padding
-        y1 = image.shape[0] - padding
+        # transpose here. The transpose and crop are views so the only copy
+        # of the image is made when it is written out.
+        image = np.asarray(output_multislice.data[0].psi_coh).T
+        x0 = fov.padding
+        y0 = fov.padding
+        x1 = image.shape[1] - fov.padding
+        y1 = image.shape[0] - fov.padding
         image = image[y0:y1, x0:x1]
 
         # Print some info
-        psi_tot = np.abs(image) ** 2
+        psi_tot = np.square(image.real) + np.square(image.imag)
         logger.info("Ideal image min/max: %f/%f" % (np.min(psi_tot), np.max(psi_tot)))
 
         # Get the timestamp
         timestamp = time.time()
 
         # Set the metaadata
-        metadata = self.metadata[index]
+        metadata = self.metadata[index].copy()
         metadata["image_number"] = image_number
         metadata["fraction_number"] = fraction_number
         metadata["timestamp"] = timestamp
@@ -339,8 +400,8 @@ class ExitWaveImageSimulator(object):
         metadata["energy"] = self.microscope.beam.energy
         metadata["theta"] = self.microscope.beam.theta
         metadata["phi"] = self.microscope.beam.phi
-        metadata["image_size_x"] = nx
-        metadata["image_size_y"] = ny
+        metadata["image_size_x"] = fov.nx
+        metadata["image_size_y"] = fov.ny
         metadata["ice"] = self.simulation["ice"]
         metadata["damage_model"] = self.simulation["radiation_damage_model"]
         metadata["sensitivity_coefficient"] = self.simulation["sensitivity_coefficient"]
@@ -377,6 +438,9 @@ def simulation_factory(
     # Get the margin
     margin = 0 if simulation is None else simulation.get("margin", 0)
 
+    # Get the number of images to write in a single block
+    batch_size = 1 if simulation is None else simulation.get("batch_size", 1)
+
     # Create the simulation
     return Simulation(
         image_size=(
@@ -386,6 +450,7 @@ def simulation_factory(
         pixel_size=microscope.detector.pixel_size,
         scan=scan,
         cluster=cluster,
+        batch_size=batch_size,
         simulate_image=ExitWaveImageSimulator(
             microscope=microscope,
             sample=sample,
@@ -485,6 +550,8 @@ def _exit_wave_Config(
         dtype=np.complex64,
     )
 
-    # Run the simulation
-    simulation.simulate_image.metadata = writer.header
+    # Run the simulation. The simulator fills in a copy of the header which
+    # is written back with each image; the header itself wraps the open file
+    # and can't be sent to other processes.
+    simulation.simulate_image.metadata = np.asarray(writer.header)
     simulation.run(writer)
@@ -53,6 +53,12 @@ class ImageSimulator(object):
         self.simulation = simulation
         self.device = device
 
+        # The seed for the noise. Each image gets its own stream spawned from
+        # this so the noise is independent of which worker simulates it. The
+        # seed is drawn from the global generator so that np.random.seed still
+        # makes the simulation reproducible.
+        self.seed = np.random.randint(0, 2**63, dtype=np.int64)
+
     def __call__(self, index):
         """
         Simulate a single frame
@@ -102,12 +108,17 @@ class ImageSimulator(object):
             fft_image *= dqe
             image = np.real(np.fft.ifft2(fft_image))
 
-        # Ensure all pixels are >= 0
+        # Ensure all pixels are >= 0 and scale to the number of electrons per
+        # pixel. The clip makes the only copy of the image and the scaling is
+        # done in place on that copy.
         image = np.clip(image, 0, None)
+        image *= electrons_per_pixel
 
         # Add Poisson noise
-        # np.random.seed(index)
-        image = np.random.poisson(image * electrons_per_pixel).astype("float64")
+        rng = np.random.default_rng(
+            np.random.SeedSequence(int(self.seed), spawn_key=(index,))
+        )
+        image = rng.poisson(image).astype(np.float32)
 
         # Print some info
         logger.info(
@@ -123,7 +134,7 @@ class ImageSimulator(object):
         metadata["offset"] = 0
 
         # Compute the image scaled with Poisson noise
-        return (index, image.astype("float32"), metadata)
+        return (index, image, metadata)
 
 
 def simulation_factory(
@@ -150,12 +161,16 @@ def simulation_factory(
 
     """
 
+    # Get the number of images to write in a single block
+    batch_size = 1 if simulation is None else simulation.get("batch_size", 1)
+
     # Create the simulation
     return Simulation(
         image_size=(microscope.detector.nx, microscope.detector.ny),
         pixel_size=microscope.detector.pixel_size,
         scan=scan,
         cluster=cluster,
+        batch_size=batch_size,
         simulate_image=ImageSimulator(
             microscope=microscope,
             optics=optics,
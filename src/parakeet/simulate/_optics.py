@@ -66,6 +66,61 @@ class OpticsImageSimulator(object):
         self.simulation = simulation
         self.sample = sample
         self.device = device
+        self._system_conf = None
+        self._input_multislice = None
+
+    def __getstate__(self):
+        """
+        Don't pickle the cached multem objects
+
+        """
+        state = self.__dict__.copy()
+        state["_system_conf"] = None
+        state["_input_multislice"] = None
+        return state
+
+    def get_input_multislice(self):
+        """
+        Get the multem system configuration and input multislice object
+
+        These are created once on the first call and then reused. Only the
+        beam and lens parameters which can change between images are updated
+        for each image.
+
+        Returns:
+            tuple: (system_conf, input_multislice)
+
+        """
+        if self._input_multislice is None:
+            # The field of view
+            nx = self.microscope.detector.nx
+            ny = self.microscope.detector.ny
+            pixel_size = self.microscope.detector.pixel_size
+            x_fov = nx * pixel_size
+            y_fov = ny * pixel_size
+            offset = self.simulation["margin"] * pixel_size
+
+            # Create the multem system configuration
+            self._system_conf = (
+                parakeet.simulate.simulation.create_system_configuration(self.device)
+            )
+
+            # Create the multem input multislice object
+            self._input_multislice = (
+                parakeet.simulate.simulation.create_input_multislice(
+                    self.microscope,
+                    self.simulation["slice_thickness"],
+                    self.simulation["margin"],
+                    "HRTEM",
+                )
+            )
+
+            # Set the specimen size
+            self._input_multislice.spec_lx = x_fov + offset * 2
+            self._input_multislice.spec_ly = y_fov + offset * 2
+            self._input_multislice.spec_lz = x_fov  # self.sample.containing_box[1][2]
+
+        return self._system_conf, self._input_multislice
 
     def __call__(self, index):
         """
@@ -80,30 +135,33 @@ class OpticsImageSimulator(object):
 
         """
 
-        def compute_image(
-            psi, microscope, simulation, x_fov, y_fov, offset, device, defocus=None
-        ):
-            # Create the multem system configuration
-            system_conf = parakeet.simulate.simulation.create_system_configuration(
-                device
-            )
-
+        def compute_image(psi, microscope, defocus=None):
             # Set the defocus
             if defocus is not None:
                 microscope.lens.c_10 = defocus
 
-            # Create the multem input multislice object
-            input_multislice = parakeet.simulate.simulation.create_input_multislice(
-                microscope, simulation["slice_thickness"], simulation["margin"], "HRTEM"
-            )
+            # Get the multem system configuration and input multislice object
+            system_conf, input_multislice = self.get_input_multislice()
 
-            # Set the specimen size
-            input_multislice.spec_lx = x_fov + offset * 2
-            input_multislice.spec_ly = y_fov + offset * 2
-            input_multislice.spec_lz = x_fov  # self.sample.containing_box[1][2]
+            # Update the beam and lens parameters which can be changed by the
+            # inelastic models
+            input_multislice.E_0 = microscope.beam.energy
+            input_multislice.cond_lens_si_sigma = multem.mrad_to_sigma(
+                input_multislice.E_0, microscope.beam.illumination_semiangle
+            )
+            input_multislice.obj_lens_c_10 = microscope.lens.c_10
+            input_multislice.obj_lens_c_30 = microscope.lens.c_30
+            input_multislice.obj_lens_ti_sigma = multem.iehwgd_to_sigma(
+                parakeet.simulate.simulation.defocus_spread(
+                    microscope.lens.c_c * 1e-3 / 1e-10,  # Convert from mm to A
+                    microscope.beam.energy_spread,
+                    microscope.lens.current_spread,
+                    microscope.beam.acceleration_voltage_spread,
+                )
+            )
 
             # Compute and apply the CTF
-            ctf = np.array(multem.compute_ctf(system_conf, input_multislice)).T
+            ctf = np.asarray(multem.compute_ctf(system_conf, input_multislice)).T
 
             # Add the effect of the phase plate
             if microscope.phase_plate.use:
@@ -131,7 +189,7 @@ class OpticsImageSimulator(object):
 
             # Compute and apply the CTF
             psi = np.fft.ifft2(np.fft.fft2(psi) * ctf)
-            image = np.abs(psi) ** 2
+            image = np.square(psi.real) + np.square(psi.imag)
 
             return image
 
@@ -141,14 +199,8 @@ class OpticsImageSimulator(object):
         # Check the angle and position
         assert abs(angle - self.exit_wave.header[index]["tilt_alpha"]) < 1e7
 
-        # The field of view
-        nx = self.microscope.detector.nx
-        ny = self.microscope.detector.ny
-        pixel_size = self.microscope.detector.pixel_size
-        x_fov = nx * pixel_size
-        y_fov = ny * pixel_size
+        # The margin to remove from the image
         margin = self.simulation["margin"]
-        offset = margin * pixel_size
 
         # Get the specimen atoms
         logger.info(f"Simulating image {index+1}")
@@ -167,30 +219,12 @@ class OpticsImageSimulator(object):
         energy_shift = 0
         if self.simulation["inelastic_model"] is None:
             # If no inelastic model just calculate image as normal
-            image = compute_image(
-                psi,
-                microscope,
-                self.simulation,
-                x_fov,
-                y_fov,
-                offset,
-                self.device,
-                defocus,
-            )
+            image = compute_image(psi, microscope, defocus)
             electron_fraction = 1.0
 
         elif self.simulation["inelastic_model"] == "zero_loss":
             # Compute the image
-            image = compute_image(
-                psi,
-                microscope,
-                self.simulation,
-                x_fov,
-                y_fov,
-                offset,
-                self.device,
-                defocus,
-            )
+            image = compute_image(psi, microscope, defocus)
 
             # Calculate the fraction of electrons in the zero loss peak
             electron_fraction = parakeet.inelastic.zero_loss_fraction(shape, angle)
@@ -243,16 +277,7 @@ class OpticsImageSimulator(object):
             microscope.beam.energy_spread = elastic_spread  # dE / E
 
             # Compute the zero loss image
-            image1 = compute_image(
-                psi,
-                microscope,
-                self.simulation,
-                x_fov,
-                y_fov,
-                offset,
-                self.device,
-                defocus,
-            )
+            image1 = compute_image(psi, microscope, defocus)
 
             # Add the energy loss
             microscope.beam.energy = (beam_energy - peak) / 1000.0  # keV
@@ -265,16 +290,7 @@ class OpticsImageSimulator(object):
             print("Energy spread: %f ppm" % microscope.beam.energy_spread)
 
             # Compute the MPL image
-            image2 = compute_image(
-                psi,
-                microscope,
-                self.simulation,
-                x_fov,
-                y_fov,
-                offset,
-                self.device,
-                defocus,
-            )
+            image2 = compute_image(psi, microscope, defocus)
 
             # Save the energy shift
             energy_shift = peak
@@ -294,16 +310,7 @@ class OpticsImageSimulator(object):
             spread = sigma * sqrt(2) / (microscope.beam.energy * 1000)  # dE / E
 
             # Compute the zero loss image
-            image1 = compute_image(
-                psi,
-                microscope,
-                self.simulation,
-                x_fov,
-                y_fov,
-                offset,
-                self.device,
-                defocus,
-            )
+            image1 = compute_image(psi, microscope, defocus)
 
             # Add the energy loss
             microscope.beam.energy -= peak / 1000  # keV
@@ -314,16 +321,7 @@ class OpticsImageSimulator(object):
             print("Energy spread: %f ppm" % microscope.beam.energy_spread)
 
             # Compute the MPL image
-            image2 = compute_image(
-                psi,
-                microscope,
-                self.simulation,
-                x_fov,
-                y_fov,
-                offset,
-                self.device,
-                defocus,
-            )
+            image2 = compute_image(psi, microscope, defocus)
 
             # Compute the zero loss and mpl image fraction
             zero_loss_fraction = parakeet.inelastic.zero_loss_fraction(shape, angle)
@@ -347,16 +345,7 @@ class OpticsImageSimulator(object):
             spread = sigma * sqrt(2) / (microscope.beam.energy * 1000)
 
             # Compute the zero loss image
-            image1 = compute_image(
-                psi,
-                microscope,
-                self.simulation,
-                x_fov,
-                y_fov,
-                offset,
-                self.device,
-                defocus,
-            )
+            image1 = compute_image(psi, microscope, defocus)
 
             # Add the energy loss
             microscope.beam.energy -= peak
@@ -367,16 +356,7 @@ class OpticsImageSimulator(object):
             print("Energy spread: %f ppm" % microscope.beam.energy_spread)
 
             # Compute the MPL image
-            image2 = compute_image(
-                psi,
-                microscope,
-                self.simulation,
-                x_fov,
-                y_fov,
-                offset,
-                self.device,
-                defocus,
-            )
+            image2 = compute_image(psi, microscope, defocus)
 
             # Compute the zero loss and mpl image fraction
             zero_loss_fraction = parakeet.inelastic.zero_loss_fraction(shape, angle)
@@ -478,12 +458,16 @@ def simulation_factory(
 
     """
 
+    # Get the number of images to write in a single block
+    batch_size = 1 if simulation is None else simulation.get("batch_size", 1)
+
     # Create the simulation
     return Simulation(
         image_size=(microscope.detector.nx, microscope.detector.ny),
         pixel_size=microscope.detector.pixel_size,
         scan=scan,
         cluster=cluster,
+        batch_size=batch_size,
         simulate_image=OpticsImageSimulator(
             microscope=microscope,
             exit_wave=exit_wave,
@@ -10,8 +10,10 @@
 #
 
 import logging
+import mmap
 import mrcfile
 import numpy as np
+import os
 import warnings
 import parakeet.config
 import parakeet.dqe
@@ -45,6 +47,74 @@ except ImportError:
     warnings.warn("Could not import MULTEM")
 
 
+def _select_atoms_in_volume(z, volume_z0, zsize, slice_thickness):
+    """
+    Select the atoms which contribute to the slices which are written out
+
+    The potential is computed with dz_Proj slicing. Multem starts the slices
+    at the lowest atom and puts the whole projected potential of each atom in
+    the slice which contains its centre, so an atom only contributes to the
+    slice it is in. The centre of each slice which is written is inside the
+    volume so the slice is within half a slice thickness of it; atoms within
+    one slice thickness of the volume are therefore kept. The lowest and
+    highest atoms are also kept so that the slices are in the same place as
+    they would be with all the atoms.
+
+    Args:
+        z (array): The z coordinate of each atom
+        volume_z0 (float): The start of the volume
+        zsize (int): The number of slices in the volume
+        slice_thickness (float): The slice thickness
+
+    Returns:
+        array: The mask of selected atoms
+
+    """
+    z_min = volume_z0 - slice_thickness
+    z_max = volume_z0 + (zsize + 1) * slice_thickness
+    select = (z >= z_min) & (z <= z_max)
+    select[np.argmin(z)] = True
+    select[np.argmax(z)] = True
+    return select
+
+
+def _advise_sequential(data):
+    """
+    Tell the kernel that the memory map will be written in order
+
+    This is only available on some platforms so do nothing if it is not.
+
+    Args:
+        data (array): The memory mapped array
+
+    """
+    handle = getattr(data, "_mmap", None)
+    if handle is not None and hasattr(mmap, "MADV_SEQUENTIAL"):
+        handle.madvise(mmap.MADV_SEQUENTIAL)
+
+
+def _drop_page_cache(filename):
+    """
+    Tell the kernel that the written file will not be read again soon
+
+    The potential files are written once and can be large so this stops them
+    from pushing everything else out of the page cache. The file is not
+    synced first since that would block on the write of the whole volume;
+    the kernel only drops the pages which have already been written back.
+    This is only available on some platforms so do nothing if it is not.
+
+    Args:
+        filename (str): The filename
+
+    """
+    if hasattr(os, "posix_fadvise"):
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
 class ProjectedPotentialSimulator(object):
     """
     A class to do the actual simulation
@@ -70,6 +140,131 @@ class ProjectedPotentialSimulator(object):
         self.scan = scan
         self.simulation = simulation
         self.device = device
+        self._system_conf = None
+        self._input_multislice = None
+        self._atoms = None
+        self._fov = None
+        self._volume = None
+
+        # Get the per image stage positions and rotation matrices for the
+        # whole scan at once. The scan properties build an array for the whole
+        # scan each time they are accessed so don't do that for every image.
+        if scan is not None:
+            self._position = np.asarray(scan.position, dtype=np.float32)
+            self._rotation = (
+                R.from_rotvec(scan.orientation).as_matrix().astype(np.float32)
+            )
+
+    def __getstate__(self):
+        """
+        Don't pickle the cached multem objects
+
+        The atoms in the field of view are sent with the simulator so they are
+        read from the sample once rather than by every worker. When sent to a
+        process pool the atom data are put in shared memory and used by every
+        worker.
+
+        """
+        state = self.__dict__.copy()
+        state["_system_conf"] = None
+        state["_input_multislice"] = None
+        state["_atoms"] = self.get_atoms()
+        state["_fov"] = None
+        return state
+
+    def get_atoms(self):
+        """
+        Get the sample atoms in the field of view
+
+        The field of view is the same for every image so the atoms are read
+        from the sample once and reused. The returned table must not be
+        modified.
+
+        Returns:
+            object: The atom data table
+
+        """
+        if self._atoms is None:
+            fov = self.get_field_of_view()
+            self._atoms = self.sample.get_atoms_in_fov(fov.x0, fov.x1).data
+        return self._atoms
+
+    def get_field_of_view(self):
+        """
+        Get the field of view parameters
+
+        These do not change between images so they are computed once and
+        reused.
+
+        Returns:
+            object: The field of view
+
+        """
+        if self._fov is None:
+            self._fov = parakeet.simulate.simulation.FieldOfView.from_microscope(
+                self.microscope, margin=self.simulation["margin"]
+            )
+        return self._fov
+
+    def get_input_multislice(self):
+        """
+        Get the multem system configuration and input multislice object
+
+        These are created once on the first call and then reused for each
+        image; only the atoms need to be set by the caller.
+
+        Returns:
+            tuple: (system_conf, input_multislice)
+
+        """
+        if self._input_multislice is None:
+            fov = self.get_field_of_view()
+
+            # Create the multem system configuration
+            self._system_conf = (
+                parakeet.simulate.simulation.create_system_configuration(self.device)
+            )
+
+            # The Z centre
+            z_centre = self.sample.centre[2]
+
+            # Create the multem input multislice object
+            self._input_multislice = (
+                parakeet.simulate.simulation.create_input_multislice(
+                    self.microscope,
+                    self.simulation["slice_thickness"],
+                    self.simulation["margin"],
+                    "EWRS",
+                    z_centre,
+                )
+            )
+
+            # Set the specimen size
+            self._input_multislice.spec_lx = fov.spec_lx
+            self._input_multislice.spec_ly = fov.spec_ly
+            self._input_multislice.spec_lz = self.sample.containing_box[1][2]
+
+        return self._system_conf, self._input_multislice
+
+    def get_volume(self):
+        """
+        Get the z extent of the potential volume
+
+        This is the same for every image so it is only read from the sample
+        once.
+
+        Returns:
+            tuple: (volume_z0, zsize) - the start of the volume and the number
+                of slices
+
+        """
+        if self._volume is None:
+            volume_z0 = self.sample.shape_box[0][2]
+            volume_z1 = self.sample.shape_box[1][2]
+            slice_thickness = self.simulation["slice_thickness"]
+            zsize = int(floor((volume_z1 - volume_z0) / slice_thickness) + 1)
+            self._volume = (volume_z0, zsize)
+        return self._volume
 
     def __call__(self, index):
         """
@@ -84,103 +279,103 @@ class ProjectedPotentialSimulator(object):
 
         """
 
-        # Get the rotation angle
-        angle = self.scan.angles[index]
-        position = self.scan.position[index]
-        orientation = self.scan.orientation[index]
-        shift = self.scan.shift[index]
-        drift = self.scan.shift_delta[index]
-        beam_tilt_theta = self.scan.beam_tilt_theta[index]
-        beam_tilt_phi = self.scan.beam_tilt_phi[index]
+        # Get the stage position and rotation
+        position = self._position[index]
+        rotation = self._rotation[index]
 
         # The field of view
-        nx = self.microscope.detector.nx
-        ny = self.microscope.detector.ny
-        pixel_size = self.microscope.detector.pixel_size
-        margin = self.simulation["margin"]
-        x_fov = nx * pixel_size
-        y_fov = ny * pixel_size
-        offset = margin * pixel_size
+        fov = self.get_field_of_view()
 
         # Get the specimen atoms
         logger.info(f"Simulating image {index+1}")
 
-        # Create the sample extractor
-        x0 = (-offset, -offset)
-        x1 = (x_fov + offset, y_fov + offset)
-
-        # Create the multem system configuration
-        system_conf = parakeet.simulate.simulation.create_system_configuration(
-            self.device
-        )
-
-        # The Z centre
-        z_centre = self.sample.centre[2]
-
-        # Create the multem input multislice object
-        input_multislice = parakeet.simulate.simulation.create_input_multislice(
-            self.microscope,
-            self.simulation["slice_thickness"],
-            self.simulation["margin"],
-            "EWRS",
-            z_centre,
-        )
-
-        # Set the specimen size
-        input_multislice.spec_lx = x_fov + offset * 2
-        input_multislice.spec_ly = y_fov + offset * 2
-        input_multislice.spec_lz = self.sample.containing_box[1][2]
+        # Get the multem system configuration and input multislice object
+        system_conf, input_multislice = self.get_input_multislice()
 
         # Set the atoms in the input after translating them for the offset
-        atoms = self.sample.get_atoms_in_fov(x0, x1)
+        atoms = parakeet.sample.AtomData(data=self.get_atoms())
         logger.info("Simulating with %d atoms" % atoms.data.shape[0])
 
         # Set atom sigma
         # atoms.data["sigma"] = sigma_B
 
+        # Get the potential and thickness. Each image is written to its own
+        # file which is what the downstream tools expect
+        volume_z0, zsize = self.get_volume()
+        slice_thickness = self.simulation["slice_thickness"]
+
+        # Rotate the atoms about the sample centre and shift them for the
+        # stage position and the margin. At high tilt many atoms are rotated
+        # out of the volume which is written out so these are dropped before
+        # doing the full rotation.
         if len(atoms.data) > 0:
-            coords = atoms.data[["x", "y", "z"]].to_numpy()
-            coords = (
-                R.from_rotvec(orientation).apply(coords - self.sample.centre)
-                + self.sample.centre
-                - position
-            ).astype("float32")
-            atoms.data["x"] = coords[:, 0]
-            atoms.data["y"] = coords[:, 1]
-            atoms.data["z"] = coords[:, 2]
-
-        origin = (0, 0)
-        input_multislice.spec_atoms = atoms.translate(
-            (offset - origin[0], offset - origin[1], 0)
-        ).to_multem()
+            centre = np.array(self.sample.centre, dtype=np.float32)
+            translation = (
+                centre - position + np.array((fov.offset, fov.offset, 0), np.float32)
+            )
+            coords = atoms.data[["x", "y", "z"]].to_numpy(dtype=np.float32)
+            z = (coords - centre) @ rotation[2] + translation[2]
+            select = _select_atoms_in_volume(z, volume_z0, zsize, slice_thickness)
+            _, coords = parakeet.simulate.simulation.transform_atoms(
+                coords[select],
+                centre,
+                rotation,
+                translation,
+                (-np.inf, -np.inf, -np.inf),
+                (np.inf, np.inf, np.inf),
+            )
+            atoms.data = atoms.data[select].assign(
+                x=coords[:, 0], y=coords[:, 1], z=coords[:, 2]
+            )
+            logger.info("   Using %d atoms within the volume" % len(coords))
+        input_multislice.spec_atoms = atoms.to_multem()
         logger.info("   Got spec atoms")
-
-        # Get the potential and thickness
-        volume_z0 = self.sample.shape_box[0][2]
-        volume_z1 = self.sample.shape_box[1][2]
-        slice_thickness = self.simulation["slice_thickness"]
-        zsize = int(floor((volume_z1 - volume_z0) / slice_thickness) + 1)
-        potential = mrcfile.new_mmap(
-            "%s_%d.mrc" % (self.potential_prefix, index),
-            shape=(zsize, ny, nx),
+        filename = "%s_%d.mrc" % (self.potential_prefix, index)
+        with mrcfile.new_mmap(
+            filename,
+            shape=(zsize, fov.ny, fov.nx),
             mrc_mode=mrcfile.utils.mode_from_dtype(np.dtype(np.float32)),
             overwrite=True,
-        )
-        potential.voxel_size = tuple((pixel_size, pixel_size, slice_thickness))
-
-        def callback(z0, z1, V):
-            V = np.array(V)
-            zc = (z0 + z1) / 2.0
-            index = int(floor((zc - volume_z0) / slice_thickness))
-            print(
-                "Calculating potential for slice: %.2f -> %.2f (index: %d)"
-                % (z0, z1, index)
+        ) as potential:
+            potential.voxel_size = tuple(
+                (fov.pixel_size, fov.pixel_size, slice_thickness)
             )
-            if index < potential.data.shape[0]:
-                potential.data[index, :, :] = V[margin:-margin, margin:-margin].T
-
-        # Run the simulation
-        multem.compute_projected_potential(system_conf, input_multislice, callback)
+            _advise_sequential(potential.data)
+
+            # The loop invariants for the callback
+            data = potential.data
+            inv_dz = 1.0 / slice_thickness
+            margin = fov.margin
+
+            def callback(z0, z1, V):
+                # Wrap the slice from multem without copying it so the only
+                # copy is the write of the crop into the memory map
+                V = np.asarray(V)
+                dz = (z0 + z1) / 2.0 - volume_z0
+                index = int(dz * inv_dz)
+                if index % 16 == 0:
+                    logger.debug(
+                        "Calculating potential for slice: %.2f -> %.2f (index: %d/%d)",
+                        z0,
+                        z1,
+                        index,
+                        zsize,
+                    )
+                # Truncation is the same as floor for dz >= 0 and slices
+                # centred below the volume are skipped
+                if dz >= 0 and index < zsize:
+                    # Copy the transposed crop straight into the memory map.
+                    # This is a single strided copy with no temporary array
+                    data[index, :, :] = V[margin:-margin, margin:-margin].T
+
+            # Run the simulation
+            multem.compute_projected_potential(system_conf, input_multislice, callback)
+
+            # Make sure the data is written before the file is closed
+            potential.flush()
+
+        # The file is not read again by this process
+        _drop_page_cache(filename)
 
         # Compute the image scaled with Poisson noise
         return (index, None, None)
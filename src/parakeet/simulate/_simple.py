@@ -121,10 +121,10 @@ class SimpleImageSimulator(object):
         # Multem outputs data in column major format. In C++ and Python we
         # generally deal with data in row major format so we must do a
         # transpose here.
-        image = np.array(output_multislice.data[0].psi_coh).T
+        image = np.asarray(output_multislice.data[0].psi_coh).T
 
         # Print some info
-        psi_tot = np.abs(image) ** 2
+        psi_tot = np.square(image.real) + np.square(image.imag)
         logger.info("Ideal image min/max: %f/%f" % (np.min(psi_tot), np.max(psi_tot)))
 
         # Compute the image scaled with Poisson noise
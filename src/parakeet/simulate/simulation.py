@@ -18,6 +18,9 @@ import parakeet.freeze
 import parakeet.futures
 import parakeet.inelastic
 import parakeet.sample
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
 from math import sqrt, pi
 
 # Try to input MULTEM
@@ -49,10 +52,14 @@ def defocus_spread(Cc, dEE, dII, dVV):
     return Cc * sqrt((dEE) ** 2 + (2 * dII) ** 2 + (dVV) ** 2)
 
 
+@lru_cache(maxsize=None)
 def create_system_configuration(device):
     """
     Create an appropriate system configuration
 
+    The configuration is only created once for each device and then shared
+    so it must not be modified by the caller.
+
     Args:
         device (str): The device to use
 
@@ -85,8 +92,41 @@ def create_system_configuration(device):
     return system_conf
 
 
-def create_input_multislice(
-    microscope, slice_thickness, margin, simulation_type, centre=None
+# The lens parameters which are copied from the microscope lens model
+LENS_PARAMETERS = (
+    "m",
+    "c_10",
+    "c_12",
+    "phi_12",
+    "c_21",
+    "phi_21",
+    "c_23",
+    "phi_23",
+    "c_30",
+    "c_32",
+    "phi_32",
+    "c_34",
+    "phi_34",
+    "c_41",
+    "phi_41",
+    "c_43",
+    "phi_43",
+    "c_45",
+    "phi_45",
+    "c_50",
+    "c_52",
+    "phi_52",
+    "c_54",
+    "phi_54",
+    "c_56",
+    "phi_56",
+    "inner_aper_ang",
+    "outer_aper_ang",
+)
+
+
+def _create_input_multislice(
+    microscope, slice_thickness, margin, simulation_type, centre, lens_prefix
 ):
     """
     Create the input multislice object
@@ -95,6 +135,9 @@ def create_input_multislice(
         microscope (object): The microscope object
         slice_thickness (float): The slice thickness
         margin (int): The pixel margin
+        simulation_type (str): The multem simulation type
+        centre (float): The zero defocus plane
+        lens_prefix (str): The lens to set (obj_lens or cond_lens)
 
     Returns:
         object: The input multislice object
@@ -154,39 +197,13 @@ def create_input_multislice(
     )
     input_multislice.cond_lens_si_sigma = ssf_sigma
 
-    # Objective lens
-    input_multislice.obj_lens_m = microscope.lens.m
-    input_multislice.obj_lens_c_10 = microscope.lens.c_10
-    input_multislice.obj_lens_c_12 = microscope.lens.c_12
-    input_multislice.obj_lens_phi_12 = microscope.lens.phi_12
-    input_multislice.obj_lens_c_21 = microscope.lens.c_21
-    input_multislice.obj_lens_phi_21 = microscope.lens.phi_21
-    input_multislice.obj_lens_c_23 = microscope.lens.c_23
-    input_multislice.obj_lens_phi_23 = microscope.lens.phi_23
-    input_multislice.obj_lens_c_30 = microscope.lens.c_30
-    input_multislice.obj_lens_c_32 = microscope.lens.c_32
-    input_multislice.obj_lens_phi_32 = microscope.lens.phi_32
-    input_multislice.obj_lens_c_34 = microscope.lens.c_34
-    input_multislice.obj_lens_phi_34 = microscope.lens.phi_34
-    input_multislice.obj_lens_c_41 = microscope.lens.c_41
-    input_multislice.obj_lens_phi_41 = microscope.lens.phi_41
-    input_multislice.obj_lens_c_43 = microscope.lens.c_43
-    input_multislice.obj_lens_phi_43 = microscope.lens.phi_43
-    input_multislice.obj_lens_c_45 = microscope.lens.c_45
-    input_multislice.obj_lens_phi_45 = microscope.lens.phi_45
-    input_multislice.obj_lens_c_50 = microscope.lens.c_50
-    input_multislice.obj_lens_c_52 = microscope.lens.c_52
-    input_multislice.obj_lens_phi_52 = microscope.lens.phi_52
-    input_multislice.obj_lens_c_54 = microscope.lens.c_54
-    input_multislice.obj_lens_phi_54 = microscope.lens.phi_54
-    input_multislice.obj_lens_c_56 = microscope.lens.c_56
-    input_multislice.obj_lens_phi_56 = microscope.lens.phi_56
-    input_multislice.obj_lens_inner_aper_ang = microscope.lens.inner_aper_ang
-    input_multislice.obj_lens_outer_aper_ang = microscope.lens.outer_aper_ang
-
-    # Do we have a phase plate
-    # if microscope.phase_plate:
-    #     input_multislice.phase_shift = pi / 2.0
+    # Lens aberrations and apertures
+    for name in LENS_PARAMETERS:
+        setattr(
+            input_multislice,
+            "%s_%s" % (lens_prefix, name),
+            getattr(microscope.lens, name),
+        )
 
     # defocus spread function
     input_multislice.obj_lens_ti_sigma = multem.iehwgd_to_sigma(
@@ -212,7 +229,7 @@ def create_input_multislice(
     return input_multislice
 
 
-def create_input_multislice_diffraction(
+def create_input_multislice(
     microscope, slice_thickness, margin, simulation_type, centre=None
 ):
     """
@@ -228,120 +245,163 @@ def create_input_multislice_diffraction(
 
     """
 
-    # Initialise the input and system configuration
-    input_multislice = multem.Input()
-
-    # Set simulation experiment
-    input_multislice.simulation_type = simulation_type
+    # Create the input with the objective lens parameters
+    input_multislice = _create_input_multislice(
+        microscope, slice_thickness, margin, simulation_type, centre, "obj_lens"
+    )
 
-    # Electron-Specimen interaction model
-    input_multislice.interaction_model = "Multislice"
-    input_multislice.potential_type = "Lobato_0_12"
+    # Do we have a phase plate
+    # if microscope.phase_plate:
+    #     input_multislice.phase_shift = pi / 2.0
 
-    # Potential slicing
-    # XXX If this is set to "Planes" then for the ribosome example I found that
-    # the simulation would not work well (e.g. The image may have nothing or a
-    # single point of intensity and nothing else). Best to keep this set to
-    # dz_Proj.
-    input_multislice.potential_slicing = "dz_Proj"
+    # Return the input multislice object
+    return input_multislice
 
-    # Electron-Phonon interaction model
-    input_multislice.pn_model = "Still_Atom"  # "Frozen_Phonon"
-    # input_multislice.pn_model = "Frozen_Phonon"
-    input_multislice.pn_coh_contrib = 0
-    input_multislice.pn_single_conf = False
-    input_multislice.pn_nconf = 50
-    input_multislice.pn_dim = 110
-    input_multislice.pn_seed = 300_183
 
-    # Set the slice thickness
-    input_multislice.spec_dz = slice_thickness
+def create_input_multislice_diffraction(
+    microscope, slice_thickness, margin, simulation_type, centre=None
+):
+    """
+    Create the input multislice object
 
-    # Specimen thickness
-    input_multislice.thick_type = "Whole_Spec"
+    Args:
+        microscope (object): The microscope object
+        slice_thickness (float): The slice thickness
+        margin (int): The pixel margin
 
-    # x-y sampling
-    input_multislice.nx = microscope.detector.nx + margin * 2
-    input_multislice.ny = microscope.detector.ny + margin * 2
-    input_multislice.bwl = False
+    Returns:
+        object: The input multislice object
 
-    # Microscope parameters
-    input_multislice.E_0 = microscope.beam.energy
-    input_multislice.theta = microscope.beam.theta
-    input_multislice.phi = microscope.beam.phi
+    """
 
-    # Illumination model
-    input_multislice.illumination_model = "Partial_Coherent"
-    input_multislice.temporal_spatial_incoh = "Temporal_Spatial"
+    # Create the input with the condenser lens parameters
+    input_multislice = _create_input_multislice(
+        microscope, slice_thickness, margin, simulation_type, centre, "cond_lens"
+    )
 
     # Set the incident wave
     # For some reason need this to work with CBED
     input_multislice.iw_x = [0]  # input_multislice.spec_lx/2
     input_multislice.iw_y = [0]  # input_multislice.spec_ly/2
 
-    # Condenser lens
-    # source spread (illumination semiangle) function
-    ssf_sigma = multem.mrad_to_sigma(
-        input_multislice.E_0, microscope.beam.illumination_semiangle
-    )
-    input_multislice.cond_lens_si_sigma = ssf_sigma
-
-    # Objective lens
-    input_multislice.cond_lens_m = microscope.lens.m
-    input_multislice.cond_lens_c_10 = microscope.lens.c_10
-    input_multislice.cond_lens_c_12 = microscope.lens.c_12
-    input_multislice.cond_lens_phi_12 = microscope.lens.phi_12
-    input_multislice.cond_lens_c_21 = microscope.lens.c_21
-    input_multislice.cond_lens_phi_21 = microscope.lens.phi_21
-    input_multislice.cond_lens_c_23 = microscope.lens.c_23
-    input_multislice.cond_lens_phi_23 = microscope.lens.phi_23
-    input_multislice.cond_lens_c_30 = microscope.lens.c_30
-    input_multislice.cond_lens_c_32 = microscope.lens.c_32
-    input_multislice.cond_lens_phi_32 = microscope.lens.phi_32
-    input_multislice.cond_lens_c_34 = microscope.lens.c_34
-    input_multislice.cond_lens_phi_34 = microscope.lens.phi_34
-    input_multislice.cond_lens_c_41 = microscope.lens.c_41
-    input_multislice.cond_lens_phi_41 = microscope.lens.phi_41
-    input_multislice.cond_lens_c_43 = microscope.lens.c_43
-    input_multislice.cond_lens_phi_43 = microscope.lens.phi_43
-    input_multislice.cond_lens_c_45 = microscope.lens.c_45
-    input_multislice.cond_lens_phi_45 = microscope.lens.phi_45
-    input_multislice.cond_lens_c_50 = microscope.lens.c_50
-    input_multislice.cond_lens_c_52 = microscope.lens.c_52
-    input_multislice.cond_lens_phi_52 = microscope.lens.phi_52
-    input_multislice.cond_lens_c_54 = microscope.lens.c_54
-    input_multislice.cond_lens_phi_54 = microscope.lens.phi_54
-    input_multislice.cond_lens_c_56 = microscope.lens.c_56
-    input_multislice.cond_lens_phi_56 = microscope.lens.phi_56
-    input_multislice.cond_lens_inner_aper_ang = microscope.lens.inner_aper_ang
-    input_multislice.cond_lens_outer_aper_ang = microscope.lens.outer_aper_ang
-
     # Do we have a phase plate
     if microscope.phase_plate:
         input_multislice.phase_shift = pi / 2.0
 
-    # defocus spread function
-    input_multislice.obj_lens_ti_sigma = multem.iehwgd_to_sigma(
-        defocus_spread(
-            microscope.lens.c_c * 1e-3 / 1e-10,  # Convert from mm to A
-            microscope.beam.energy_spread,
-            microscope.lens.current_spread,
-            microscope.beam.acceleration_voltage_spread,
+    # Return the input multislice object
+    return input_multislice
+
+
+@dataclass(frozen=True)
+class FieldOfView(object):
+    """
+    The geometry of the field of view
+
+    This is the same for every image in a simulation so it is computed once
+    and used by the simulators for each image. Lengths are in A and the
+    margin and padding are in pixels.
+
+    """
+
+    nx: int
+    ny: int
+    pixel_size: float
+    origin: tuple
+    margin: int
+    padding: int
+    x_fov: float
+    y_fov: float
+    offset: float
+    spec_lx: float
+    spec_ly: float
+    x0: tuple
+    x1: tuple
+
+    @classmethod
+    def from_microscope(Class, microscope, margin=0, padding=0):
+        """
+        Get the field of view of the microscope detector
+
+        Args:
+            microscope (object): The microscope object
+            margin (int): The margin around the detector
+            padding (int): The padding around the margin
+
+        Returns:
+            object: The field of view
+
+        """
+        nx = microscope.detector.nx
+        ny = microscope.detector.ny
+        pixel_size = microscope.detector.pixel_size
+        x_fov = nx * pixel_size
+        y_fov = ny * pixel_size
+        offset = (margin + padding) * pixel_size
+        return Class(
+            nx=nx,
+            ny=ny,
+            pixel_size=pixel_size,
+            origin=tuple(microscope.detector.origin),
+            margin=margin,
+            padding=padding,
+            x_fov=x_fov,
+            y_fov=y_fov,
+            offset=offset,
+            spec_lx=x_fov + 2 * offset,
+            spec_ly=y_fov + 2 * offset,
+            x0=(-offset, -offset),
+            x1=(x_fov + offset, y_fov + offset),
         )
-    )
 
-    # zero defocus reference
-    if centre is not None:
-        input_multislice.cond_lens_zero_defocus_type = "User_Define"
-        input_multislice.obj_lens_zero_defocus_type = "User_Define"
-        input_multislice.cond_lens_zero_defocus_plane = centre
-        input_multislice.obj_lens_zero_defocus_plane = centre
-    else:
-        input_multislice.cond_lens_zero_defocus_type = "Last"
-        input_multislice.obj_lens_zero_defocus_type = "Last"
 
-    # Return the input multislice object
-    return input_multislice
+def transform_atoms(coords, centre, rotation, translation, lower, upper):
+    """
+    Rotate the atoms about a centre, translate them and clip them to a box
+
+    The rotated coordinates along each bounded axis are computed first so
+    that the atoms outside the box can be dropped before the full rotation is
+    done on the remaining atoms.
+
+    Args:
+        coords (array): The (N, 3) atom coordinates
+        centre (array): The centre of rotation
+        rotation (array): The 3x3 rotation matrix
+        translation (array): The translation to apply after the rotation
+        lower (array): The lower bound of the box (-inf for no bound)
+        upper (array): The upper bound of the box (inf for no bound)
+
+    Returns:
+        tuple: (select, coords) - The mask of atoms inside the box and their
+            transformed float32 coordinates
+
+    """
+    rotation = np.asarray(rotation, dtype=np.float32)
+    translation = np.asarray(translation, dtype=np.float32)
+    coords = np.asarray(coords, dtype=np.float32) - np.asarray(centre, dtype=np.float32)
+
+    # Find the atoms inside the box
+    select = np.ones(coords.shape[0], dtype=bool)
+    for axis in range(3):
+        if np.isfinite(lower[axis]) or np.isfinite(upper[axis]):
+            x = coords @ rotation[axis] + translation[axis]
+            select &= (x >= lower[axis]) & (x <= upper[axis])
+
+    # Rotate and translate the atoms inside the box
+    coords = np.matmul(coords[select], rotation.T)
+    coords += translation
+    return select, coords
+
+
+def _simulate_image(simulate_image, index):
+    """
+    Simulate an image on a worker
+
+    Args:
+        simulate_image (object): The handle to the image simulation function
+        index (int): The image number
+
+    """
+    return parakeet.futures.gather(simulate_image)(index)
 
 
 class Simulation(object):
@@ -351,7 +411,13 @@ class Simulation(object):
     """
 
     def __init__(
-        self, image_size, pixel_size, scan=None, cluster=None, simulate_image=None
+        self,
+        image_size,
+        pixel_size,
+        scan=None,
+        cluster=None,
+        simulate_image=None,
+        batch_size=1,
     ):
         """
         Initialise the simulation
@@ -361,6 +427,7 @@ class Simulation(object):
             scan (object): The scan object
             cluster (object): The cluster spec
             simulate_image (func): The image simulation function
+            batch_size (int): The number of images to write in a single block
 
         """
         self.pixel_size = pixel_size
@@ -368,6 +435,7 @@ class Simulation(object):
         self.scan = scan
         self.cluster = cluster
         self.simulate_image = simulate_image
+        self.batch_size = max(1, batch_size)
 
     @property
     def shape(self):
@@ -390,6 +458,57 @@ class Simulation(object):
             zip(self.scan.image_number, self.scan.fraction_number, self.scan.angles)
         )
 
+    def write_batch(self, writer, start, images, metadata):
+        """
+        Write a batch of consecutive images to the writer
+
+        Args:
+            writer (object): The writer object
+            start (int): The index of the first image
+            images (array): The stack or list of images
+            metadata (list): The metadata for each image
+
+        """
+        if writer.is_image_writer:
+            for k, image in enumerate(images):
+                writer.data[start + k, :, :] = image
+        else:
+            writer.data[start : start + len(images), :, :] = images
+        for k, m in enumerate(metadata):
+            if m is not None:
+                writer.header[start + k] = m
+
+    def write_pending(self, writer, pending, next_index):
+        """
+        Write any images which follow on from the last image written
+
+        Args:
+            writer (object): The writer object
+            pending (dict): The (image, metadata) for each image not yet written
+            next_index (int): The index of the next image to write
+
+        Returns:
+            int: The index of the next image to write
+
+        """
+        while next_index in pending:
+            start = next_index
+            images = []
+            metadata = []
+            while next_index in pending and len(images) < self.batch_size:
+                image, image_metadata = pending.pop(next_index)
+                images.append(image)
+                metadata.append(image_metadata)
+                next_index += 1
+            # A single image is written through a view rather than copying
+            # it into a new stack
+            if len(images) == 1:
+                images = images[0][np.newaxis]
+            elif not writer.is_image_writer:
+                images = np.stack(images)
+            self.write_batch(writer, start, images, metadata)
+        return next_index
+
     def run(self, writer=None):
         """
         Run the simulation
@@ -403,17 +522,48 @@ class Simulation(object):
         if writer:
             assert writer.shape == self.shape
 
-        # If we are executing in a single process just do a for loop
+        # If we are executing in a single process just do a for loop. The
+        # images are simulated in batches and each batch is written to the
+        # output file as a single block rather than image by image. The
+        # writing is done on a background thread so that the next batch can
+        # be simulated while the previous one is written. Two buffers are
+        # used so that a buffer is never filled while it is being written.
         if self.cluster is None or self.cluster["method"] is None:
-            for i, (image_number, fraction_number, angle) in enumerate(self.angles()):
-                logger.info(
-                    f"    Running job: {i+1}/{self.shape[0]} for image {image_number} fraction {fraction_number} with tilt {angle} degrees"
-                )
-                _, image, metadata = self.simulate_image(i)
-                if writer is not None:
-                    writer.data[i, :, :] = image
-                    if metadata is not None:
-                        writer.header[i] = metadata
+            angles = self.angles()
+            buffers = None
+            if writer is not None and not writer.is_image_writer:
+                buffers = [
+                    np.zeros(
+                        (self.batch_size,) + tuple(writer.shape[1:]),
+                        dtype=writer.dtype,
+                    )
+                    for _ in range(2)
+                ]
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                pending = None
+                for n, i0 in enumerate(range(0, len(angles), self.batch_size)):
+                    i1 = min(i0 + self.batch_size, len(angles))
+                    images = [] if buffers is None else buffers[n % 2][: i1 - i0]
+                    metadata = []
+                    for i in range(i0, i1):
+                        image_number, fraction_number, angle = angles[i]
+                        logger.info(
+                            f"    Running job: {i+1}/{self.shape[0]} for image {image_number} fraction {fraction_number} with tilt {angle} degrees"
+                        )
+                        _, image, image_metadata = self.simulate_image(i)
+                        if buffers is None:
+                            images.append(image)
+                        else:
+                            images[i - i0] = image
+                        metadata.append(image_metadata)
+                    if writer is not None:
+                        if pending is not None:
+                            pending.result()
+                        pending = executor.submit(
+                            self.write_batch, writer, i0, images, metadata
+                        )
+                if pending is not None:
+                    pending.result()
         else:
             # Set the maximum number of workers
             self.cluster["max_workers"] = min(
@@ -423,35 +573,71 @@ class Simulation(object):
 
             # Get the futures executor
             with parakeet.futures.factory(**self.cluster) as executor:
-                # Copy the data to each worker
+                # Copy the simulation function to each worker once rather
+                # than sending it along with each job
                 logger.info("Copying data to workers...")
-
-                # Submit all jobs
-                logger.info("Running simulation...")
-                futures = []
-                for i, (image_number, fraction_number, angle) in enumerate(
-                    self.scan.angles
-                ):
-                    logger.info(
-                        f"    Running job: {i+1}/{self.shape[0]} for image {image_number} fraction {fraction_number} with tilt {angle} degrees"
-                    )
-                    futures.append(executor.submit(self.simulate_image, i))
-
-                # Wait for results
-                for j, future in enumerate(parakeet.futures.as_completed(futures)):
-                    # Get the result
-                    i, image, metadata = future.result()
-
-                    # Set the output in the writer
-                    if writer is not None:
-                        writer.data[i, :, :] = image
-                        if metadata is not None:
-                            writer.header[i] = metadata
-
-                    # Write some info
-                    vmin = np.min(image)
-                    vmax = np.max(image)
-                    logger.info(
-                        "    Processed job: %d (%d/%d); image min/max: %.2f/%.2f"
-                        % (i + 1, j + 1, self.shape[0], vmin, vmax)
-                    )
+                simulate_image = parakeet.futures.scatter(executor, self.simulate_image)
+                running = set()
+                try:
+                    # Submit the jobs. Only a limited number of jobs are kept in
+                    # flight at once and a new job is submitted each time one
+                    # finishes so the scheduler is not flooded with every image
+                    # of a large scan up front.
+                    logger.info("Running simulation...")
+                    angles = self.angles()
+                    window = 2 * self.cluster["max_workers"]
+                    submitted = 0
+
+                    # The results arrive in any order so hold on to them until
+                    # the next image in the sequence is ready and then write that
+                    # contiguous run as a single block
+                    pending = {}
+                    next_index = 0
+                    j = 0
+                    while submitted < len(angles) or len(running) > 0:
+                        # Top up the jobs which are in flight
+                        while submitted < len(angles) and len(running) < window:
+                            i = submitted
+                            image_number, fraction_number, angle = angles[i]
+                            logger.info(
+                                f"    Running job: {i+1}/{self.shape[0]} for image {image_number} fraction {fraction_number} with tilt {angle} degrees"
+                            )
+                            running.add(
+                                executor.submit(_simulate_image, simulate_image, i)
+                            )
+                            submitted += 1
+
+                        # Wait for at least one job to finish
+                        done, running = parakeet.futures.wait(running)
+                        for future in done:
+                            # Get the result
+                            i, image, metadata = future.result()
+
+                            # Set the output in the writer
+                            if writer is not None:
+                                pending[i] = (image, metadata)
+                                next_index = self.write_pending(
+                                    writer, pending, next_index
+                                )
+
+                            # Write some info. Some simulations (e.g. the
+                            # projected potential) write their own output and do
+                            # not return an image.
+                            if image is not None:
+                                vmin = np.min(image)
+                                vmax = np.max(image)
+                                logger.info(
+                                    "    Processed job: %d (%d/%d); image min/max: %.2f/%.2f"
+                                    % (i + 1, j + 1, self.shape[0], vmin, vmax)
+                                )
+                            else:
+                                logger.info(
+                                    "    Processed job: %d (%d/%d)"
+                                    % (i + 1, j + 1, self.shape[0])
+                                )
+                            j += 1
+                finally:
+                    # Make sure no job is still using the shared data before
+                    # it is freed, e.g. if a job failed
+                    parakeet.futures.cancel(running)
+                    parakeet.futures.release(simulate_image)
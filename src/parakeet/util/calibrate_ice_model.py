@@ -723,7 +723,7 @@ def compute_exit_wave(atom_data, pixel_size):
     output_multislice = multem.simulate(system_conf, input_multislice)
 
     # Get the image
-    physical_image = np.array(output_multislice.data[0].psi_coh).T
+    physical_image = np.asarray(output_multislice.data[0].psi_coh).T
 
     # Create the masker
     masker = multem.Masker(input_multislice.nx, input_multislice.ny, pixel_size)
@@ -743,7 +743,7 @@ def compute_exit_wave(atom_data, pixel_size):
     output_multislice = multem.simulate(system_conf, input_multislice, masker)
 
     # Get the image
-    random_image = np.array(output_multislice.data[0].psi_coh).T
+    random_image = np.asarray(output_multislice.data[0].psi_coh).T
 
     # Return the images
     x0 = np.array((x_box_size / 2 - x_size / 2, y_box_size / 2 - y_size / 2))
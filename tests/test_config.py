@@ -74,5 +74,27 @@ def test_load(tmp_path):
     assert dict_approx_equal(config.dict(), parakeet.config.default().dict())
 
 
+def test_load_cached(tmp_path):
+    filename = os.path.join(tmp_path, "tmp.yaml")
+    parakeet.config.new(filename)
+
+    # Changing the loaded config does not change the cached one
+    config = parakeet.config.load(filename)
+    config.device = "cpu"
+    assert parakeet.config.load(filename).device == "gpu"
+
+    # Changing the file gives the new config even if the size and
+    # modification time are the same
+    stat = os.stat(filename)
+    with open(filename) as infile:
+        text = infile.read()
+    assert "num_images: 1\n" in text
+    with open(filename, "w") as outfile:
+        outfile.write(text.replace("num_images: 1\n", "num_images: 2\n"))
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert os.stat(filename).st_size == stat.st_size
+    assert parakeet.config.load(filename).scan.num_images == 2
+
+
 def test_show():
     parakeet.config.show(parakeet.config.Config())
@@ -0,0 +1,90 @@
+import numpy as np
+import os
+import pickle
+import pandas as pd
+import pytest
+import parakeet.futures
+from multiprocessing.shared_memory import SharedMemory
+
+
+class DummySimulator(object):
+    def __init__(self, size):
+        self.atoms = pd.DataFrame(
+            {
+                "atomic_number": np.full(size, 6, dtype=np.uint8),
+                "x": np.arange(size, dtype=np.float32),
+                "y": np.zeros(size, dtype=np.float32),
+                "z": np.zeros(size, dtype=np.float32),
+            }
+        )
+
+    def __call__(self, index):
+        x = self.atoms["x"].to_numpy()
+        return (
+            os.getpid(),
+            id(self),
+            x.flags.writeable,
+            float(x.sum(dtype=np.float64)),
+        )
+
+
+def _simulate(handle, index):
+    return parakeet.futures.gather(handle)(index)
+
+
+def test_scatter_process_pool():
+    size = 2**21
+    simulator = DummySimulator(size)
+
+    with parakeet.futures.factory("multiprocessing", max_workers=2) as executor:
+        handle = parakeet.futures.scatter(executor, simulator)
+        futures = []
+        try:
+            # The atoms are in shared memory so only a small pickle is sent
+            assert len(handle.segments) > 0
+            assert len(handle.data) < 10000
+
+            futures = [executor.submit(_simulate, handle, i) for i in range(8)]
+            results = [f.result() for f in futures]
+        finally:
+            parakeet.futures.cancel(futures)
+            segments = handle.segments
+            parakeet.futures.release(handle)
+
+    # The workers see read only views of the shared atoms
+    for pid, _, writeable, total in results:
+        assert pid != os.getpid()
+        assert not writeable
+        assert total == pytest.approx(size * (size - 1) / 2)
+
+    # The object is only unpickled once in each worker
+    instances = {}
+    for pid, instance, _, _ in results:
+        instances.setdefault(pid, set()).add(instance)
+    assert all(len(v) == 1 for v in instances.values())
+
+    # The shared memory is freed
+    for name in segments:
+        with pytest.raises(FileNotFoundError):
+            SharedMemory(name=name)
+
+
+def test_scatter_structured_array():
+    dtype = np.dtype([("image_number", "u8"), ("shift", "f8", (2,)), ("text", "S16")])
+    metadata = np.zeros(2 * parakeet.futures.SHARED_MEMORY_THRESHOLD // 8, dtype)
+    metadata["image_number"] = np.arange(metadata.size)
+    metadata["text"] = b"test"
+
+    handle = parakeet.futures.SharedObject(metadata)
+    try:
+        assert len(handle.segments) == 1
+        result = pickle.loads(pickle.dumps(handle)).result()
+
+        # The field names are kept
+        assert result.dtype == dtype
+        np.testing.assert_equal(result["image_number"], metadata["image_number"])
+        row = result[10].copy()
+        row["image_number"] = 0
+        assert row["text"] == b"test"
+    finally:
+        handle.release()
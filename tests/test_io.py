@@ -1,5 +1,6 @@
 import numpy as np
 import os
+import pickle
 import pytest
 import parakeet.io
 
@@ -73,6 +74,7 @@ def test_write_nexus(tmp_path, io_test_data):
         writer.header[i]["stage_z"] = position[i][2]
 
     assert writer.shape == data.shape
+    assert writer.data.chunks == (1, 100, 100)
     assert writer.is_mrcfile_writer == False
     assert writer.is_nexus_writer == True
     assert writer.is_image_writer == False
@@ -95,6 +97,30 @@ def test_write_nexus(tmp_path, io_test_data):
     assert np.all(np.equal(reader.header.position, position))
 
 
+@pytest.mark.parametrize("extension", ["h5", "mrc"])
+def test_reader_pickle(tmp_path, io_test_data, extension):
+    filename = os.path.join(tmp_path, "tmp.%s" % extension)
+
+    data, angle, position = io_test_data
+
+    writer = parakeet.io.new(filename, shape=data.shape)
+
+    # A copy of the header can be filled in and written back a row at a time
+    header = np.asarray(writer.header)
+    for i in range(data.shape[0]):
+        writer.data[i, :, :] = data[i, :, :]
+        header[i]["tilt_alpha"] = angle[i]
+        writer.header[i] = header[i]
+    writer = None
+
+    # The reader is pickled by filename and reopened
+    reader = pickle.loads(pickle.dumps(parakeet.io.open(filename)))
+    assert reader.filename == filename
+    assert reader.data.shape == (10, 100, 100)
+    assert np.all(np.equal(reader.data[:], data))
+    assert np.all(np.equal(reader.header["tilt_alpha"], angle))
+
+
 def test_write_images(tmp_path, io_test_data):
     filename = os.path.join(tmp_path, "tmp_%03d.png")
 
@@ -3,6 +3,7 @@ import os
 import pytest
 import parakeet.config
 import parakeet.sample
+import pickle
 import shutil
 from math import sqrt
 
@@ -198,6 +199,29 @@ def test_AtomData(atom_data_4v5d):
         assert atom_data_4v5d.data[name].dtype == dtype
 
 
+def test_AtomData_to_multem(monkeypatch):
+    import types
+
+    # Check the atom list is built in chunks with the same rows
+    monkeypatch.setattr(
+        parakeet.sample, "multem", types.SimpleNamespace(AtomList=list), raising=False
+    )
+    size = 250_001
+    atoms = parakeet.sample.AtomData(
+        atomic_number=np.full(size, 6),
+        x=np.arange(size),
+        y=np.arange(size) * 2,
+        z=np.arange(size) * 3,
+        sigma=np.full(size, 0.085),
+        occupancy=np.ones(size),
+        charge=np.zeros(size),
+    )
+    result = atoms.to_multem()
+    assert len(result) == size
+    for i in [0, 99_999, 100_000, size - 1]:
+        assert result[i] == (6, i, i * 2, i * 3, np.float32(0.085), 1, 0, 0)
+
+
 def test_SampleHDF5Adapter(tmp_path, atom_data_4v5d):
     # Get handle
     handle = parakeet.sample.SampleHDF5Adapter(
@@ -308,6 +332,28 @@ def test_Sample(tmp_path, atom_data_4v5d):
     sample.close()
 
 
+def test_Sample_pickle(tmp_path, atom_data_4v5d):
+    filename = os.path.join(tmp_path, "test_Sample_pickle.h5")
+    sample = parakeet.sample.Sample(filename, mode="w")
+    sample.add_molecule(
+        atom_data_4v5d,
+        positions=[(200, 200, 200)],
+        orientations=[(0, 0, 0)],
+        name="4v5d",
+    )
+    sample.close()
+
+    sample = parakeet.sample.Sample(filename, mode="r")
+    data = pickle.dumps(sample)
+    assert len(data) < 1000
+
+    other = pickle.loads(data)
+    assert other.molecules == ["4v5d"]
+    assert other.number_of_atoms == sample.number_of_atoms
+    other.close()
+    sample.close()
+
+
 def test_AtomSliceExtractor(tmp_path):
     config = {
         "box": (50, 50, 50),
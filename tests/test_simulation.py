@@ -0,0 +1,497 @@
+import numpy as np
+import os
+import pytest
+import parakeet.config
+import parakeet.futures
+import parakeet.io
+import parakeet.microscope
+import parakeet.scan
+from parakeet.simulate.simulation import Simulation
+
+
+class DummyImageSimulator(object):
+    def __init__(self, shape):
+        self.shape = shape
+
+    def __call__(self, index):
+        return (index, np.full(self.shape, index, dtype=np.float32), None)
+
+
+@pytest.mark.parametrize("batch_size", [1, 3, 10])
+@pytest.mark.parametrize("extension", ["h5", "mrc"])
+def test_simulation_run(tmp_path, batch_size, extension):
+    filename = os.path.join(tmp_path, "tmp.%s" % extension)
+
+    scan = parakeet.scan.new("tilt_series", start_angle=0, step_angle=1, num_images=7)
+
+    simulation = Simulation(
+        image_size=(20, 10),
+        pixel_size=1,
+        scan=scan,
+        simulate_image=DummyImageSimulator((10, 20)),
+        batch_size=batch_size,
+    )
+
+    writer = parakeet.io.new(filename, shape=simulation.shape, dtype=np.float32)
+    simulation.run(writer)
+
+    assert writer.shape == (7, 10, 20)
+    for i in range(7):
+        assert np.all(writer.data[i, :, :] == i)
+
+
+def test_simulation_write_pending(tmp_path):
+    filename = os.path.join(tmp_path, "tmp.h5")
+
+    scan = parakeet.scan.new("tilt_series", start_angle=0, step_angle=1, num_images=7)
+
+    simulation = Simulation(
+        image_size=(20, 10),
+        pixel_size=1,
+        scan=scan,
+        simulate_image=DummyImageSimulator((10, 20)),
+        batch_size=2,
+    )
+
+    writer = parakeet.io.new(filename, shape=simulation.shape, dtype=np.float32)
+
+    pending = {}
+    next_index = 0
+    for i in [2, 1, 6, 0, 3, 5, 4]:
+        _, image, metadata = simulation.simulate_image(i)
+        pending[i] = (image, metadata)
+        next_index = simulation.write_pending(writer, pending, next_index)
+        assert all(j >= next_index for j in pending)
+    assert next_index == 7
+    assert len(pending) == 0
+
+    for i in range(7):
+        assert np.all(writer.data[i, :, :] == i)
+
+
+def test_field_of_view():
+    import dataclasses
+    import pickle
+    from parakeet.simulate.simulation import FieldOfView
+
+    microscope = parakeet.microscope.new(
+        parakeet.config.Microscope(detector={"nx": 20, "ny": 10, "pixel_size": 2})
+    )
+    fov = FieldOfView.from_microscope(microscope, margin=3, padding=1)
+    assert (fov.nx, fov.ny, fov.pixel_size) == (20, 10, 2)
+    assert (fov.x_fov, fov.y_fov, fov.offset) == (40, 20, 8)
+    assert (fov.spec_lx, fov.spec_ly) == (56, 36)
+    assert fov.x0 == (-8, -8)
+    assert fov.x1 == (48, 28)
+    assert pickle.loads(pickle.dumps(fov)) == fov
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        fov.nx = 10
+
+
+def test_transform_atoms():
+    from parakeet.simulate.simulation import transform_atoms
+    from scipy.spatial.transform import Rotation as R
+
+    coords = np.random.uniform(0, 100, size=(1000, 3)).astype(np.float32)
+    centre = np.array((50, 50, 50))
+    rotation = R.from_rotvec((0.3, 0.2, 0.1)).as_matrix()
+    translation = np.array((10, 20, 30))
+    lower = (0, 20, -np.inf)
+    upper = (80, 90, np.inf)
+
+    select, result = transform_atoms(
+        coords, centre, rotation, translation, lower, upper
+    )
+
+    # The mask is computed in float32 so use the same arithmetic here and
+    # check that exactly the same atoms are selected
+    shifted = coords - centre.astype(np.float32)
+    mask = np.ones(len(coords), dtype=bool)
+    for axis in range(2):
+        x = shifted @ rotation[axis].astype(np.float32)
+        x += translation[axis].astype(np.float32)
+        mask &= (x >= lower[axis]) & (x <= upper[axis])
+    assert 0 < np.count_nonzero(mask) < len(coords)
+    np.testing.assert_array_equal(select, mask)
+
+    # The coordinates are the same as the double precision transform to
+    # within float32 precision
+    expected = (coords - centre) @ rotation.T + translation
+    assert result.dtype == np.float32
+    np.testing.assert_allclose(result, expected[mask], rtol=0, atol=1e-4)
+
+
+def test_select_atoms_in_volume():
+    from parakeet.simulate._potential import _select_atoms_in_volume
+
+    def project(z, value, volume_z0, zsize, dz):
+        # Slice the atoms like multem does with dz_Proj slicing: the slices
+        # start at the lowest atom and each atom is put in the slice which
+        # contains it. Then set the slices in the volume like the callback
+        z_grid = np.min(z)
+        slice_index = np.floor((z - z_grid) / dz).astype(int)
+        potential = np.bincount(slice_index, weights=value)
+        result = np.zeros(zsize)
+        for i, v in enumerate(potential):
+            offset = z_grid + (i + 0.5) * dz - volume_z0
+            index = int(offset / dz)
+            if offset >= 0 and index < zsize:
+                result[index] = v
+        return result
+
+    np.random.seed(0)
+    z = np.random.uniform(-503.7, 498.1, size=10000).astype(np.float32)
+    value = np.random.uniform(0, 1, size=z.size)
+    volume_z0 = -52.3
+    zsize = 21
+    dz = 5.0
+
+    select = _select_atoms_in_volume(z, volume_z0, zsize, dz)
+    assert np.count_nonzero(select) < z.size // 5
+    expected = project(z, value, volume_z0, zsize, dz)
+    result = project(z[select], value[select], volume_z0, zsize, dz)
+    assert np.all(expected != 0)
+    np.testing.assert_array_equal(result, expected)
+
+
+class DummySlabSample(object):
+    def __init__(self, size):
+        import parakeet.sample
+
+        np.random.seed(0)
+        self.centre = (25, 25, 100)
+        self.containing_box = ((0, 0, 0), (50, 50, 200))
+        self.shape_box = ((0, 0, 75), (50, 50, 125))
+        self.atoms = parakeet.sample.AtomData(
+            atomic_number=np.full(size, 6),
+            x=np.random.uniform(0, 50, size).astype(np.float32),
+            y=np.random.uniform(0, 50, size).astype(np.float32),
+            z=np.random.uniform(0, 200, size).astype(np.float32),
+            sigma=np.full(size, 0.085, dtype=np.float32),
+            occupancy=np.ones(size, dtype=np.float32),
+            charge=np.zeros(size),
+        )
+
+    def get_atoms_in_fov(self, x0, x1):
+        return self.atoms
+
+
+def test_potential_simulator_select_atoms(tmp_path, monkeypatch):
+    import mrcfile
+    import types
+    import parakeet.simulate._potential
+
+    pytest.importorskip("multem")
+
+    microscope = parakeet.microscope.new(
+        parakeet.config.Microscope(detector={"nx": 50, "ny": 50, "pixel_size": 1})
+    )
+    scan = types.SimpleNamespace(
+        position=[(0, 0, 0)], orientation=[(0, np.radians(30), 0)]
+    )
+
+    def simulate(prefix):
+        simulator = parakeet.simulate._potential.ProjectedPotentialSimulator(
+            potential_prefix=str(tmp_path / prefix),
+            microscope=microscope,
+            sample=DummySlabSample(5000),
+            scan=scan,
+            simulation={"slice_thickness": 5, "margin": 10},
+            device="cpu",
+        )
+        simulator(0)
+        with mrcfile.open(tmp_path / f"{prefix}_0.mrc") as potential:
+            return potential.data.copy()
+
+    # Compute the potential with the atoms outside the slab dropped
+    result = simulate("select")
+
+    # Compute the potential with all the atoms
+    monkeypatch.setattr(
+        parakeet.simulate._potential,
+        "_select_atoms_in_volume",
+        lambda z, *args: np.ones(z.shape, dtype=bool),
+    )
+    expected = simulate("all")
+
+    # The potential in the slab is the same
+    assert result.shape == (11, 50, 50)
+    assert np.all(expected.max(axis=(1, 2)) > 0)
+    np.testing.assert_allclose(result, expected, atol=1e-4 * expected.max())
+
+
+class DummySample(object):
+    def __init__(self):
+        self.num_reads = 0
+
+    def get_atoms_in_fov(self, x0, x1):
+        import parakeet.sample
+
+        self.num_reads += 1
+        return parakeet.sample.AtomData(
+            atomic_number=np.full(4, 6),
+            x=np.arange(4, dtype=np.float32),
+            y=np.zeros(4, dtype=np.float32),
+            z=np.zeros(4, dtype=np.float32),
+            sigma=np.zeros(4, dtype=np.float32),
+            occupancy=np.ones(4, dtype=np.float32),
+            charge=np.zeros(4),
+        )
+
+
+def test_potential_simulator_atoms():
+    import pickle
+    from parakeet.simulate._potential import ProjectedPotentialSimulator
+
+    microscope = parakeet.microscope.new(
+        parakeet.config.Microscope(detector={"nx": 20, "ny": 10, "pixel_size": 2})
+    )
+    simulator = ProjectedPotentialSimulator(
+        microscope=microscope,
+        sample=DummySample(),
+        simulation={"margin": 3},
+    )
+
+    # The atoms in the field of view are read once and sent with the simulator
+    atoms = simulator.get_atoms()
+    assert simulator.get_atoms() is atoms
+    assert simulator.sample.num_reads == 1
+    worker = pickle.loads(pickle.dumps(simulator))
+    assert worker.get_atoms().equals(atoms)
+    assert worker.sample.num_reads == 1
+
+
+def test_drop_page_cache(tmp_path, monkeypatch):
+    from parakeet.simulate._potential import _drop_page_cache
+
+    filename = os.path.join(tmp_path, "potential.dat")
+    data = np.arange(1024, dtype=np.float32)
+    data.tofile(filename)
+
+    # Works on a real file and leaves the contents alone
+    _drop_page_cache(filename)
+    assert np.all(np.fromfile(filename, dtype=np.float32) == data)
+
+    # Does nothing where posix_fadvise is not available, so doesn't even try
+    # to open the file
+    monkeypatch.delattr(os, "posix_fadvise", raising=False)
+    _drop_page_cache(os.path.join(tmp_path, "missing.dat"))
+
+
+def test_image_simulator_noise(tmp_path):
+    from parakeet.simulate._image import ImageSimulator
+
+    scan = parakeet.scan.new("tilt_series", start_angle=0, step_angle=1, num_images=3)
+    microscope = parakeet.microscope.new(
+        parakeet.config.Microscope(detector={"nx": 20, "ny": 10})
+    )
+
+    optics = parakeet.io.new(
+        os.path.join(tmp_path, "optics.h5"), shape=(3, 10, 20), dtype=np.float32
+    )
+    for i in range(3):
+        optics.data[i, :, :] = np.ones((10, 20))
+        optics.header[i]["tilt_alpha"] = scan.angles[i]
+
+    np.random.seed(0)
+    simulator = ImageSimulator(microscope=microscope, optics=optics, scan=scan)
+    images = [simulator(i)[1] for i in range(3)]
+
+    # The same image gets the same noise each time and the images are
+    # independent of each other
+    assert np.all(simulator(1)[1] == images[1])
+    assert not np.all(images[0] == images[1])
+
+    # Seeding the global generator gives reproducible noise
+    np.random.seed(0)
+    other = ImageSimulator(microscope=microscope, optics=optics, scan=scan)
+    assert np.all(other(2)[1] == images[2])
+
+
+def test_simulation_run_multiprocessing(tmp_path):
+    filename = os.path.join(tmp_path, "tmp.h5")
+
+    scan = parakeet.scan.new("tilt_series", start_angle=0, step_angle=1, num_images=7)
+
+    simulation = Simulation(
+        image_size=(20, 10),
+        pixel_size=1,
+        scan=scan,
+        cluster={"method": "multiprocessing", "max_workers": 2},
+        simulate_image=DummyImageSimulator((10, 20)),
+        batch_size=2,
+    )
+
+    writer = parakeet.io.new(filename, shape=simulation.shape, dtype=np.float32)
+    simulation.run(writer)
+
+    for i in range(7):
+        assert np.all(writer.data[i, :, :] == i)
+
+
+@pytest.mark.parametrize("extension", ["h5", "mrc"])
+def test_image_simulation_run_multiprocessing(tmp_path, extension):
+    import parakeet.simulate._image
+
+    scan = parakeet.scan.new("tilt_series", start_angle=0, step_angle=1, num_images=3)
+    microscope = parakeet.microscope.new(
+        parakeet.config.Microscope(detector={"nx": 20, "ny": 10})
+    )
+
+    optics_file = os.path.join(tmp_path, "optics.%s" % extension)
+    optics = parakeet.io.new(optics_file, shape=(3, 10, 20), dtype=np.float32)
+    for i in range(3):
+        optics.data[i, :, :] = np.ones((10, 20))
+        optics.header[i]["tilt_alpha"] = scan.angles[i]
+    optics = None
+
+    def run(cluster, filename):
+        # The simulator holds the open optics file which is sent to the workers
+        np.random.seed(0)
+        simulation = parakeet.simulate._image.simulation_factory(
+            microscope,
+            parakeet.io.open(optics_file),
+            scan,
+            simulation={"batch_size": 1},
+            cluster=cluster,
+        )
+        writer = parakeet.io.new(filename, shape=simulation.shape, dtype=np.float32)
+        simulation.run(writer)
+        return writer
+
+    expected = run(None, os.path.join(tmp_path, "expected.h5"))
+    result = run(
+        {"method": "multiprocessing", "max_workers": 2},
+        os.path.join(tmp_path, "result.h5"),
+    )
+    assert np.all(result.data[:] == expected.data[:])
+    assert np.all(result.header["tilt_alpha"][:] == expected.header["tilt_alpha"][:])
+
+
+def test_simulation_run_dask(tmp_path, monkeypatch):
+    dask_distributed = pytest.importorskip("dask.distributed")
+
+    # Run the jobs on a local dask cluster rather than on SGE
+    def factory(method="sge", max_workers=1):
+        return dask_distributed.Client(
+            processes=False,
+            n_workers=max_workers,
+            threads_per_worker=1,
+            dashboard_address=None,
+        )
+
+    monkeypatch.setattr(parakeet.futures, "factory", factory)
+
+    # More images than the number of jobs kept in flight so the window of
+    # jobs is topped up as they finish
+    scan = parakeet.scan.new("tilt_series", start_angle=0, step_angle=1, num_images=11)
+
+    simulation = Simulation(
+        image_size=(20, 10),
+        pixel_size=1,
+        scan=scan,
+        cluster={"method": "sge", "max_workers": 2},
+        simulate_image=DummyImageSimulator((10, 20)),
+        batch_size=2,
+    )
+
+    filename = os.path.join(tmp_path, "tmp.h5")
+    writer = parakeet.io.new(filename, shape=simulation.shape, dtype=np.float32)
+    simulation.run(writer)
+
+    for i in range(11):
+        assert np.all(writer.data[i, :, :] == i)
+
+
+class DummyFailingSimulator(object):
+    def __init__(self, shape):
+        self.image = np.zeros(shape, dtype=np.float32)
+        self.atoms = np.zeros(2**20, dtype=np.float32)
+
+    def __call__(self, index):
+        if index == 2:
+            raise ValueError("Simulation failed")
+        return (index, self.image + self.atoms[index], None)
+
+
+def test_simulation_run_multiprocessing_error(tmp_path):
+    scan = parakeet.scan.new("tilt_series", start_angle=0, step_angle=1, num_images=7)
+
+    simulation = Simulation(
+        image_size=(20, 10),
+        pixel_size=1,
+        scan=scan,
+        cluster={"method": "multiprocessing", "max_workers": 2},
+        simulate_image=DummyFailingSimulator((10, 20)),
+    )
+
+    # The error from the job is raised once the other jobs have finished with
+    # the shared data
+    filename = os.path.join(tmp_path, "tmp.h5")
+    writer = parakeet.io.new(filename, shape=simulation.shape, dtype=np.float32)
+    with pytest.raises(ValueError):
+        simulation.run(writer)
+
+
+class DummyFileSimulator(object):
+    def __init__(self, directory):
+        self.directory = directory
+
+    def __call__(self, index):
+        np.save(os.path.join(self.directory, "%d.npy" % index), np.array([index]))
+        return (index, None, None)
+
+
+def test_simulation_run_multiprocessing_no_image(tmp_path):
+    scan = parakeet.scan.new("tilt_series", start_angle=0, step_angle=1, num_images=3)
+
+    simulation = Simulation(
+        image_size=(20, 10),
+        pixel_size=1,
+        scan=scan,
+        cluster={"method": "multiprocessing", "max_workers": 2},
+        simulate_image=DummyFileSimulator(str(tmp_path)),
+    )
+    simulation.run()
+
+    for i in range(3):
+        assert np.load(os.path.join(tmp_path, "%d.npy" % i))[0] == i
+
+
+def _sample_shape_radius(sample):
+    return sample.shape_radius
+
+
+def test_run_multiprocessing(tmp_path, monkeypatch):
+    import parakeet._run
+    import parakeet.sample
+    import parakeet.simulate
+
+    config = parakeet.config.new(str(tmp_path / "config.yaml"))
+    config.sample.box = (200, 200, 200)
+    config.sample.centre = (100, 100, 100)
+    config.sample.shape.type = "cube"
+    config.sample.shape.cube.length = 100
+    config.cluster.method = "multiprocessing"
+    config.cluster.max_workers = 2
+
+    # Check the sample can be opened by the workers while the run holds it
+    results = []
+
+    def exit_wave(config, sample, exit_wave_file):
+        with parakeet.futures.factory(
+            config.cluster.method, max_workers=config.cluster.max_workers
+        ) as executor:
+            results.append(executor.submit(_sample_shape_radius, sample).result())
+
+    monkeypatch.setattr(parakeet.simulate, "exit_wave", exit_wave)
+    parakeet._run.run(
+        config,
+        str(tmp_path / "sample.h5"),
+        str(tmp_path / "exit_wave.h5"),
+        str(tmp_path / "optics.h5"),
+        str(tmp_path / "image.h5"),
+        steps=["sample.new", "simulate.exit_wave"],
+    )
+    sample = parakeet.sample.load(str(tmp_path / "sample.h5"))
+    assert results == [sample.shape_radius]